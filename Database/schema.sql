@@ -30,6 +30,7 @@ CREATE TABLE IF NOT EXISTS scans (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     store_id UUID REFERENCES stores(id) ON DELETE CASCADE,
     image_url TEXT NOT NULL,
+    pending_upload BOOLEAN DEFAULT false,
     status TEXT DEFAULT 'processing', -- processing, completed, failed
     shelf_health_score INTEGER,
     products_detected INTEGER DEFAULT 0,
@@ -44,6 +45,8 @@ CREATE TABLE IF NOT EXISTS scans (
 
 CREATE INDEX IF NOT EXISTS idx_scans_store_id ON scans(store_id);
 CREATE INDEX IF NOT EXISTS idx_scans_created_at ON scans(created_at DESC);
+-- Databases created before pending_upload existed
+ALTER TABLE scans ADD COLUMN IF NOT EXISTS pending_upload BOOLEAN DEFAULT false;
 CREATE TABLE IF NOT EXISTS detected_products (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     scan_id UUID REFERENCES scans(id) ON DELETE CASCADE,
@@ -63,6 +66,28 @@ CREATE INDEX IF NOT EXISTS idx_products_scan_id ON detected_products(scan_id);
 CREATE INDEX IF NOT EXISTS idx_products_store_id ON detected_products(store_id);
 CREATE INDEX IF NOT EXISTS idx_products_stock_level ON detected_products(stock_level);
 CREATE INDEX IF NOT EXISTS idx_products_category ON detected_products(category);
+
+-- Unique products a store has ever had detected (dashboard "products tracked")
+CREATE OR REPLACE FUNCTION count_distinct_products(p_store_id UUID)
+RETURNS INTEGER
+LANGUAGE sql STABLE
+AS $$
+    SELECT COUNT(DISTINCT product_name)::INTEGER FROM detected_products WHERE store_id = p_store_id;
+$$;
+
+-- Top 10 products seen across a pincode's stores (services/neighborhood_service.py)
+CREATE OR REPLACE FUNCTION popular_products_by_pincode(p TEXT)
+RETURNS TABLE (product TEXT, scan_count BIGINT)
+LANGUAGE sql STABLE
+AS $$
+    SELECT dp.product_name, COUNT(*) AS scan_count
+    FROM detected_products dp
+    JOIN stores st ON st.id = dp.store_id
+    WHERE st.pincode = p AND dp.product_name IS NOT NULL AND dp.product_name <> ''
+    GROUP BY dp.product_name
+    ORDER BY scan_count DESC
+    LIMIT 10;
+$$;
 CREATE TABLE IF NOT EXISTS debate_rounds (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     scan_id UUID REFERENCES scans(id) ON DELETE CASCADE,
@@ -90,6 +115,21 @@ CREATE TABLE IF NOT EXISTS voice_notes (
 
 CREATE INDEX IF NOT EXISTS idx_voice_scan_id ON voice_notes(scan_id);
 CREATE INDEX IF NOT EXISTS idx_voice_store_id ON voice_notes(store_id);
+
+-- Parsed Gemini Vision output keyed by blake2b(image bytes), reused for duplicate photos
+CREATE TABLE IF NOT EXISTS vision_cache (
+    hash TEXT PRIMARY KEY,
+    data JSONB NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Synthesized voice clips keyed by sha256(voice_id|text), reused across scans
+CREATE TABLE IF NOT EXISTS tts_cache (
+    hash TEXT PRIMARY KEY,
+    audio_url TEXT NOT NULL,
+    duration_seconds INTEGER,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
 CREATE TABLE IF NOT EXISTS product_catalog (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     product_name TEXT NOT NULL,
@@ -116,6 +156,120 @@ CREATE TABLE IF NOT EXISTS neighborhood_demand (
 
 CREATE INDEX IF NOT EXISTS idx_neighborhood_pincode ON neighborhood_demand(pincode);
 CREATE INDEX IF NOT EXISTS idx_neighborhood_week ON neighborhood_demand(week_start DESC);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_neighborhood_pincode_week ON neighborhood_demand(pincode, week_start);
+-- Per-scan stockout merge into the pincode's latest row (called from main.py _update_neighborhood).
+-- Accepts stockout_products stored either as encoded text or as a real array.
+CREATE OR REPLACE FUNCTION append_stockouts(p_pincode TEXT, p_stockouts JSONB, p_categories JSONB)
+RETURNS UUID
+LANGUAGE sql
+AS $$
+WITH latest AS (
+    SELECT id,
+           CASE WHEN jsonb_typeof(stockout_products) = 'string'
+                THEN (stockout_products #>> '{}')::jsonb
+                ELSE COALESCE(stockout_products, '[]'::jsonb)
+           END AS current_stockouts
+    FROM neighborhood_demand
+    WHERE pincode = p_pincode
+    ORDER BY week_start DESC NULLS LAST
+    LIMIT 1
+    FOR UPDATE
+)
+UPDATE neighborhood_demand nd SET
+    stockout_products = to_jsonb(COALESCE(
+        (SELECT jsonb_agg(DISTINCT e) FROM jsonb_array_elements(l.current_stockouts || p_stockouts) e),
+        '[]'::jsonb)::text),
+    top_categories = to_jsonb(p_categories::text),
+    total_stores_scanned = COALESCE(nd.total_stores_scanned, 0) + 1,
+    updated_at = NOW()
+FROM latest l
+WHERE nd.id = l.id
+RETURNING nd.id;
+$$;
+
+-- Weekly neighborhood demand rollup (called nightly by services/aggregation_service.py).
+-- JSON columns hold encoded text, matching what the API writes elsewhere.
+CREATE OR REPLACE FUNCTION aggregate_neighborhood_demand(p_week_start DATE)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+WITH active_stores AS (
+    SELECT DISTINCT st.id, st.pincode, st.city
+    FROM scans s
+    JOIN stores st ON st.id = s.store_id
+    WHERE s.created_at >= NOW() - INTERVAL '7 days'
+),
+products AS (
+    SELECT a.pincode, dp.product_name, dp.category, dp.stock_level
+    FROM detected_products dp
+    JOIN active_stores a ON a.id = dp.store_id
+    WHERE dp.detected_at >= NOW() - INTERVAL '7 days'
+),
+totals AS (
+    SELECT pincode,
+           COUNT(*) AS total,
+           COUNT(DISTINCT product_name) AS unique_products,
+           COUNT(*) FILTER (WHERE stock_level = 'critical') AS stockouts,
+           COUNT(*) FILTER (WHERE stock_level = 'low') AS lows
+    FROM products
+    GROUP BY pincode
+),
+stockouts AS (
+    SELECT pincode, product_name, COUNT(*) AS n,
+           ROW_NUMBER() OVER (PARTITION BY pincode ORDER BY COUNT(*) DESC, product_name) AS rn
+    FROM products
+    WHERE stock_level = 'critical'
+    GROUP BY pincode, product_name
+),
+categories AS (
+    SELECT pincode, category, COUNT(*) AS n,
+           ROW_NUMBER() OVER (PARTITION BY pincode ORDER BY COUNT(*) DESC, category) AS rn
+    FROM products
+    WHERE category IS NOT NULL AND category <> ''
+    GROUP BY pincode, category
+),
+upserted AS (
+    INSERT INTO neighborhood_demand (
+        pincode, city, week_start, total_stores_scanned,
+        top_categories, stockout_products, demand_signals, updated_at
+    )
+    SELECT
+        t.pincode,
+        (SELECT MIN(a.city) FROM active_stores a WHERE a.pincode = t.pincode),
+        p_week_start,
+        (SELECT COUNT(*) FROM active_stores a WHERE a.pincode = t.pincode),
+        to_jsonb(COALESCE(
+            (SELECT jsonb_agg(jsonb_build_object('category', c.category, 'count', c.n) ORDER BY c.rn)
+             FROM categories c WHERE c.pincode = t.pincode AND c.rn <= 8),
+            '[]'::jsonb)::text),
+        to_jsonb(COALESCE(
+            (SELECT jsonb_agg(jsonb_build_object('product', so.product_name, 'times_critical', so.n) ORDER BY so.rn)
+             FROM stockouts so WHERE so.pincode = t.pincode AND so.rn <= 10),
+            '[]'::jsonb)::text),
+        to_jsonb(jsonb_build_object(
+            'total_products_scanned', t.total,
+            'unique_products', t.unique_products,
+            'stockout_rate', ROUND(t.stockouts * 100.0 / t.total, 1),
+            'low_stock_rate', ROUND(t.lows * 100.0 / t.total, 1),
+            'top_stockouts', COALESCE(
+                (SELECT jsonb_agg(so.product_name ORDER BY so.rn)
+                 FROM stockouts so WHERE so.pincode = t.pincode AND so.rn <= 5),
+                '[]'::jsonb)
+        )::text),
+        NOW()
+    FROM totals t
+    ON CONFLICT (pincode, week_start) DO UPDATE SET
+        city = EXCLUDED.city,
+        total_stores_scanned = EXCLUDED.total_stores_scanned,
+        top_categories = EXCLUDED.top_categories,
+        stockout_products = EXCLUDED.stockout_products,
+        demand_signals = EXCLUDED.demand_signals,
+        updated_at = EXCLUDED.updated_at
+    RETURNING 1
+)
+SELECT COUNT(*)::INTEGER FROM upserted;
+$$;
+
 CREATE TABLE IF NOT EXISTS whatsapp_messages (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     store_id UUID REFERENCES stores(id),
@@ -137,6 +291,8 @@ ALTER TABLE detected_products ENABLE ROW LEVEL SECURITY;
 ALTER TABLE debate_rounds ENABLE ROW LEVEL SECURITY;
 ALTER TABLE voice_notes ENABLE ROW LEVEL SECURITY;
 ALTER TABLE neighborhood_demand ENABLE ROW LEVEL SECURITY;
+ALTER TABLE tts_cache ENABLE ROW LEVEL SECURITY;
+ALTER TABLE vision_cache ENABLE ROW LEVEL SECURITY;
 CREATE POLICY "Allow all for anon" ON stores FOR ALL USING (true) WITH CHECK (true);
 CREATE POLICY "Allow all for anon" ON scans FOR ALL USING (true) WITH CHECK (true);
 CREATE POLICY "Allow all for anon" ON detected_products FOR ALL USING (true) WITH CHECK (true);
@@ -145,6 +301,8 @@ CREATE POLICY "Allow all for anon" ON voice_notes FOR ALL USING (true) WITH CHEC
 CREATE POLICY "Allow all for anon" ON neighborhood_demand FOR ALL USING (true) WITH CHECK (true);
 CREATE POLICY "Allow all for anon" ON product_catalog FOR ALL USING (true) WITH CHECK (true);
 CREATE POLICY "Allow all for anon" ON whatsapp_messages FOR ALL USING (true) WITH CHECK (true);
+CREATE POLICY "Allow all for anon" ON tts_cache FOR ALL USING (true) WITH CHECK (true);
+CREATE POLICY "Allow all for anon" ON vision_cache FOR ALL USING (true) WITH CHECK (true);
 
 INSERT INTO product_catalog (product_name, brand, category, typical_mrp) VALUES
 ('Parle-G Biscuits', 'Parle', 'Biscuits', 10),
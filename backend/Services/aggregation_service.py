@@ -2,128 +2,192 @@
 ShelfScan AI — Nightly Neighborhood Demand Aggregation
 =======================================================
 Aggregates detected_products by pincode into the neighborhood_demand table.
+The work runs in Postgres via the aggregate_neighborhood_demand() RPC (see
+Database/schema.sql); a client-side fallback is used if it isn't deployed.
 Run this as a cron job or Railway scheduled task:
 
   Schedule: 0 2 * * *  (2 AM IST daily)
   Command:  python -c "import asyncio; from services.aggregation_service import run_aggregation; asyncio.run(run_aggregation())"
 """
 
-import json
+import asyncio
+import orjson
 from datetime import datetime, timedelta
 from collections import Counter, defaultdict
+from operator import itemgetter
+from typing import Optional
 from database import db
 
+# Every column here is in the detected_products select, so the keys are always present
+_PRODUCT_FIELDS = itemgetter("product_name", "stock_level", "category")
+
+# Rows requested per detected_products page in the client-side fallback
+PRODUCT_PAGE_SIZE = 5000
+
 
 async def run_aggregation():
     """Main aggregation job — runs across all pincodes with recent activity."""
-    print(f"[{datetime.utcnow().isoformat()}] Starting neighborhood demand aggregation...")
+    now = datetime.utcnow()
+    now_iso = now.isoformat()
+    week_ago_iso = (now - timedelta(days=7)).isoformat()
+    week_start = (now.date() - timedelta(days=now.weekday())).isoformat()
+
+    print(f"[{now_iso}] Starting neighborhood demand aggregation...")
+
+    try:
+        # Preferred path: Postgres groups and upserts every pincode in one call
+        result = await db.execute(db.client.rpc("aggregate_neighborhood_demand", {"p_week_start": week_start}))
+        print(f"Aggregation complete. Processed {result.data} pincodes.")
+        return
+    except Exception as e:
+        print(f"Server-side aggregation unavailable ({e}); aggregating client-side...")
+
+    await _aggregate_client_side(now_iso, week_ago_iso, week_start)
 
-    week_start = (datetime.utcnow() - timedelta(days=datetime.utcnow().weekday())).strftime("%Y-%m-%d")
 
+async def _aggregate_client_side(now_iso: str, week_ago_iso: str, week_start: str):
+    """Fallback when the aggregate_neighborhood_demand RPC isn't deployed — same output, computed in Python."""
     try:
         # Get all distinct pincodes with scans in the last 7 days
-        recent_scans = (
+        recent_scans = await db.execute(
             db.client.table("scans")
             .select("store_id, created_at")
-            .gte("created_at", (datetime.utcnow() - timedelta(days=7)).isoformat())
-            .execute()
+            .gte("created_at", week_ago_iso)
         )
-        store_ids = list(set(s["store_id"] for s in (recent_scans.data or [])))
+        store_ids = list(dict.fromkeys(s["store_id"] for s in (recent_scans.data or [])))
 
         if not store_ids:
             print("No recent scans found. Exiting.")
             return
 
         # Get pincode for each active store
-        stores = (
+        stores = await db.execute(
             db.client.table("stores")
             .select("id, pincode, city")
             .in_("id", store_ids)
-            .execute()
         )
-        pincode_map = {s["id"]: (s["pincode"], s["city"]) for s in (stores.data or [])}
+        pincode_map = {s["id"]: s["pincode"] for s in (stores.data or [])}
 
-        # Group store_ids by pincode
+        # Group store_ids by pincode. City is free text, so one pincode can carry several
+        # spellings; pick one (like MIN(city) in the RPC) so each pincode yields a single row
         by_pincode = defaultdict(list)
-        for store_id, (pincode, city) in pincode_map.items():
-            by_pincode[(pincode, city)].append(store_id)
-
-        # For each pincode, aggregate products
-        for (pincode, city), pin_store_ids in by_pincode.items():
-            await _aggregate_pincode(pincode, city, pin_store_ids, week_start)
-
-        print(f"Aggregation complete. Processed {len(by_pincode)} pincodes.")
+        cities = defaultdict(set)
+        for s in stores.data or []:
+            by_pincode[s["pincode"]].append(s["id"])
+            if s.get("city"):
+                cities[s["pincode"]].add(s["city"])
+        pincode_city = {pincode: min(names) for pincode, names in cities.items()}
+
+        # Stream this week's products page by page, folding each page into per-pincode tallies
+        # so memory stays O(page size) however many detections a pincode has
+        tallies = defaultdict(_new_tally)
+        active_store_ids = list(pincode_map)
+        offset = 0
+        while True:
+            page = await db.execute(
+                db.client.table("detected_products")
+                .select("product_name, category, stock_level, store_id")
+                .in_("store_id", active_store_ids)
+                .gte("detected_at", week_ago_iso)
+                .order("id")
+                .range(offset, offset + PRODUCT_PAGE_SIZE - 1)
+            )
+            rows = page.data or []
+            if not rows:
+                break
+            page_by_pincode = defaultdict(list)
+            for p in rows:
+                if p["store_id"] in pincode_map:
+                    page_by_pincode[pincode_map[p["store_id"]]].append(p)
+            for key, pin_rows in page_by_pincode.items():
+                _tally_products(tallies[key], pin_rows)
+            # Advance by what came back: PostgREST may cap pages below PRODUCT_PAGE_SIZE
+            offset += len(rows)
+
+        # Tallies are already in memory, so building the records is pure CPU — no need for concurrency
+        records = []
+        failed = 0
+        for pincode, pin_store_ids in by_pincode.items():
+            try:
+                record = _aggregate_pincode(
+                    pincode, pincode_city.get(pincode), pin_store_ids, tallies.get(pincode), week_start,
+                    now_iso=now_iso
+                )
+            except Exception as e:
+                failed += 1
+                print(f"  ✗ Pincode {pincode} aggregation failed: {e}")
+                continue
+            if record:
+                records.append(record)
+
+        # Write every pincode's record in one upsert (unique on pincode + week_start)
+        if records:
+            await db.execute(
+                db.client.table("neighborhood_demand")
+                .upsert(records, on_conflict="pincode,week_start")
+            )
+
+        print(f"Aggregation complete. Processed {len(by_pincode)} pincodes ({failed} failed).")
 
     except Exception as e:
         print(f"Aggregation error: {e}")
 
 
-async def _aggregate_pincode(pincode: str, city: str, store_ids: list, week_start: str):
-    """Aggregate product data for a single pincode."""
-    try:
-        # Get all products detected in these stores this week
-        products = (
-            db.client.table("detected_products")
-            .select("product_name, brand, category, stock_level, store_id")
-            .in_("store_id", store_ids)
-            .gte("detected_at", (datetime.utcnow() - timedelta(days=7)).isoformat())
-            .execute()
-        )
-        all_products = products.data or []
-
-        if not all_products:
-            return
-
-        # Compute aggregates
-        stockout_items = [p["product_name"] for p in all_products if p["stock_level"] == "critical"]
-        low_items = [p["product_name"] for p in all_products if p["stock_level"] == "low"]
-        categories = [p["category"] for p in all_products if p.get("category")]
-
-        stockout_counts = Counter(stockout_items).most_common(10)
-        category_counts = Counter(categories).most_common(8)
-
-        top_categories = [{"category": k, "count": v} for k, v in category_counts]
-        stockout_products = [{"product": k, "times_critical": v} for k, v in stockout_counts]
-
-        demand_signals = {
-            "total_products_scanned": len(all_products),
-            "unique_products": len(set(p["product_name"] for p in all_products)),
-            "stockout_rate": round(len(stockout_items) / len(all_products) * 100, 1),
-            "low_stock_rate": round(len(low_items) / len(all_products) * 100, 1),
-            "top_stockouts": [p for p, _ in stockout_counts[:5]]
-        }
-
-        # Upsert into neighborhood_demand
-        existing = (
-            db.client.table("neighborhood_demand")
-            .select("id")
-            .eq("pincode", pincode)
-            .eq("week_start", week_start)
-            .execute()
-        )
-
-        record = {
-            "pincode": pincode,
-            "city": city,
-            "week_start": week_start,
-            "total_stores_scanned": len(store_ids),
-            "top_categories": json.dumps(top_categories),
-            "stockout_products": json.dumps(stockout_products),
-            "demand_signals": json.dumps(demand_signals),
-            "updated_at": datetime.utcnow().isoformat()
-        }
-
-        if existing.data:
-            db.client.table("neighborhood_demand").update(record).eq("id", existing.data[0]["id"]).execute()
-        else:
-            db.client.table("neighborhood_demand").insert({**record, "created_at": datetime.utcnow().isoformat()}).execute()
-
-        print(f"  ✓ Pincode {pincode} ({city}): {len(all_products)} products, {len(stockout_items)} stockouts")
-
-    except Exception as e:
-        print(f"  ✗ Pincode {pincode} aggregation failed: {e}")
+def _new_tally() -> dict:
+    return {"total": 0, "names": set(), "stockouts": Counter(), "low": Counter(), "categories": Counter()}
+
+
+def _tally_products(tally: dict, products: list):
+    """Fold a batch of detected_products rows into a pincode tally in a single pass."""
+    names, stockout_c, low_c, category_c = tally["names"], tally["stockouts"], tally["low"], tally["categories"]
+    for name, stock_level, category in map(_PRODUCT_FIELDS, products):
+        names.add(name)
+        if stock_level == "critical":
+            stockout_c[name] += 1
+        elif stock_level == "low":
+            low_c[name] += 1
+        if category:
+            category_c[category] += 1
+    tally["total"] += len(products)
+
+
+def _aggregate_pincode(pincode: str, city: str, store_ids: list, tally: Optional[dict], week_start: str,
+                       now_iso: str) -> Optional[dict]:
+    """Turn a pincode's product tally for this week into a neighborhood_demand record; raises on bad data."""
+    if not tally or not tally["total"]:
+        return None
+
+    total = tally["total"]
+    stockout_total = sum(tally["stockouts"].values())
+    low_total = sum(tally["low"].values())
+    stockout_counts = tally["stockouts"].most_common(10)
+    category_counts = tally["categories"].most_common(8)
+
+    top_categories = [{"category": k, "count": v} for k, v in category_counts]
+    stockout_products = [{"product": k, "times_critical": v} for k, v in stockout_counts]
+
+    demand_signals = {
+        "total_products_scanned": total,
+        "unique_products": len(tally["names"]),
+        "stockout_rate": round(stockout_total / total * 100, 1),
+        "low_stock_rate": round(low_total / total * 100, 1),
+        "top_stockouts": [p for p, _ in stockout_counts[:5]]
+    }
+
+    record = {
+        "pincode": pincode,
+        "city": city,
+        "week_start": week_start,
+        "total_stores_scanned": len(store_ids),
+        "top_categories": orjson.dumps(top_categories).decode(),
+        "stockout_products": orjson.dumps(stockout_products).decode(),
+        "demand_signals": orjson.dumps(demand_signals).decode(),
+        "updated_at": now_iso
+    }
+
+    print(f"  ✓ Pincode {pincode} ({city}): {total} products, {stockout_total} stockouts")
+    return record
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(run_aggregation())
@@ -1,11 +1,20 @@
 """ShelfScan AI - Cloudinary Upload Service"""
+import asyncio
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 import base64
 import io
+from typing import BinaryIO, Union
+from PIL import Image, ImageOps
 from config import settings
 
+# Matches the Cloudinary "limit" transformation so we never upload more pixels than are kept
+MAX_IMAGE_SIZE = (1280, 960)
+
+# Audio is sent in chunks via upload_large
+AUDIO_CHUNK_SIZE = 6 * 1024 * 1024
+
 cloudinary.config(
     cloud_name=settings.CLOUDINARY_CLOUD_NAME,
     api_key=settings.CLOUDINARY_API_KEY,
@@ -14,11 +23,28 @@ cloudinary.config(
 )
 
 
-async def upload_image(image_bytes: bytes, store_id: str) -> str:
-    """Upload shelf image to Cloudinary, return secure URL"""
+def fit_image(image: Union[bytes, BinaryIO], max_size: tuple[int, int]) -> Union[bytes, BinaryIO]:
+    """Resize to fit max_size and re-encode as JPEG; returns the input unchanged if undecodable"""
+    try:
+        source = io.BytesIO(image) if isinstance(image, (bytes, bytearray)) else image
+        img = ImageOps.exif_transpose(Image.open(source))
+        img.thumbnail(max_size, Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+        return buf.getvalue()
+    except Exception:
+        if hasattr(image, "seek"):
+            image.seek(0)
+        return bytes(image) if isinstance(image, bytearray) else image
+
+
+async def upload_image(image: Union[bytes, BinaryIO], store_id: str) -> str:
+    """Upload shelf image to Cloudinary, return secure URL. Accepts bytes or a binary file object."""
     try:
-        result = cloudinary.uploader.upload(
-            image_bytes,
+        image = await asyncio.to_thread(fit_image, image, MAX_IMAGE_SIZE)
+        result = await asyncio.to_thread(
+            cloudinary.uploader.upload,
+            image,
             folder=f"shelfscan/{store_id}",
             resource_type="image",
             tags=["shelfscan", "kirana", store_id],
@@ -31,11 +57,13 @@ async def upload_image(image_bytes: bytes, store_id: str) -> str:
         raise Exception(f"Cloudinary upload failed: {str(e)}")
 
 
-async def upload_audio(audio_bytes: bytes, scan_id: str) -> str:
+async def upload_audio(audio_bytes: Union[bytes, bytearray], scan_id: str) -> str:
     """Upload voice note audio to Cloudinary"""
     try:
-        result = cloudinary.uploader.upload(
-            audio_bytes,
+        result = await asyncio.to_thread(
+            cloudinary.uploader.upload_large,
+            io.BytesIO(audio_bytes),
+            chunk_size=AUDIO_CHUNK_SIZE,
             folder=f"shelfscan/audio/{scan_id}",
             resource_type="video",  # Cloudinary uses 'video' for audio files
             tags=["shelfscan", "voice_note", scan_id],
@@ -4,20 +4,25 @@ ShelfScan AI — Multi-Agent Debate Service
 
 AGENT ARCHITECTURE:
   Round 1 — PRESENTER  : Gemini 1.5 Pro   (best vision-context reasoning)
-  Round 2 — CRITIC     : GPT-4o Mini (primary) → Groq LLaMA-3.1 (free) → Together Mixtral (free) → Gemini Flash (fallback)
+  Round 2 — CRITIC     : GPT-4o Mini | Groq LLaMA-3.1 (free) | Together Mixtral (free), raced → Gemini Flash (fallback)
   Round 3 — DECIDER    : Gemini 1.5 Pro   (synthesis + Hindi voice text)
 """
 
+import asyncio
 import google.generativeai as genai
-import httpx
-import json
-import re
+import orjson
 from typing import Optional
 from config import settings
+from http_client import http
 
 genai.configure(api_key=settings.GEMINI_API_KEY)
 
-PRESENTER_PROMPT = """You are the PRESENTER agent in ShelfScan AI's 3-agent debate for Indian kirana store shelf optimization.
+_PRO_MODEL = genai.GenerativeModel("gemini-1.5-pro")
+_FLASH_MODEL = genai.GenerativeModel("gemini-1.5-flash")
+
+
+def _presenter_prompt(store_name: str, city: str, pincode: str, store_type: str, language: str, vision_data: str) -> str:
+    return f"""You are the PRESENTER agent in ShelfScan AI's 3-agent debate for Indian kirana store shelf optimization.
 
 Store: {store_name}, {city} (PIN: {pincode}) — {store_type}
 Language: {language}
@@ -41,7 +46,9 @@ Return ONLY valid JSON:
   "reasoning": "detailed explanation"
 }}"""
 
-CRITIC_PROMPT = """You are the CRITIC agent in ShelfScan AI's 3-agent debate. Challenge the Presenter's plan rigorously.
+
+def _critic_prompt(pincode: str, presenter_output: str, vision_data: str) -> str:
+    return f"""You are the CRITIC agent in ShelfScan AI's 3-agent debate. Challenge the Presenter's plan rigorously.
 
 Pincode: {pincode}
 Presenter's Plan: {presenter_output}
@@ -67,7 +74,9 @@ Return ONLY valid JSON:
   "critique_summary": "concise summary"
 }}"""
 
-DECIDER_PROMPT = """You are the DECIDER in ShelfScan AI's 3-agent debate. Synthesize the debate into the FINAL action plan.
+
+def _decider_prompt(language: str, presenter_output: str, critic_output: str, vision_data: str) -> str:
+    return f"""You are the DECIDER in ShelfScan AI's 3-agent debate. Synthesize the debate into the FINAL action plan.
 
 Owner language: {language}
 Presenter: {presenter_output}
@@ -92,19 +101,18 @@ Return ONLY valid JSON:
 }}"""
 
 
-async def run_presenter(vision_data: dict, store_info: dict) -> dict:
+async def run_presenter(vision_data: dict, store_info: dict, vision_json: str) -> dict:
     """PRESENTER — Gemini 1.5 Pro"""
     try:
-        model = genai.GenerativeModel("gemini-1.5-pro")
-        prompt = PRESENTER_PROMPT.format(
+        prompt = _presenter_prompt(
             store_name=store_info.get("store_name", "Kirana Store"),
             city=store_info.get("city", ""),
             pincode=store_info.get("pincode", ""),
             store_type=store_info.get("store_type", "kirana"),
             language=store_info.get("primary_language", "hindi"),
-            vision_data=json.dumps(vision_data, indent=2)[:3000]
+            vision_data=vision_json[:3000]
         )
-        resp = model.generate_content(prompt, generation_config=genai.GenerationConfig(temperature=0.3, max_output_tokens=2000))
+        resp = await _PRO_MODEL.generate_content_async(prompt, generation_config=genai.GenerationConfig(temperature=0.3, max_output_tokens=2000, response_mime_type="application/json"))
         parsed = _parse_json(resp.text)
         return {"agent": "Gemini 1.5 Pro", "model": "gemini-1.5-pro", "type": "presenter", "output": parsed, "confidence": parsed.get("confidence_score", 82)}
     except Exception as e:
@@ -112,103 +120,102 @@ async def run_presenter(vision_data: dict, store_info: dict) -> dict:
         return {"agent": "Gemini 1.5 Pro", "model": "gemini-1.5-pro", "type": "presenter", "output": fb, "confidence": 60, "error": str(e)}
 
 
-async def run_critic_gpt4o(presenter_output: dict, vision_data: dict, pincode: str) -> Optional[dict]:
+async def run_critic_gpt4o(presenter_json: str, vision_json: str, pincode: str) -> Optional[dict]:
     """CRITIC — GPT-4o Mini (best economic reasoning)"""
     if not settings.OPENAI_API_KEY:
         return None
     try:
-        async with httpx.AsyncClient(timeout=30) as c:
-            r = await c.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={"Authorization": f"Bearer {settings.OPENAI_API_KEY}", "Content-Type": "application/json"},
-                json={
-                    "model": "gpt-4o-mini",
-                    "messages": [
-                        {"role": "system", "content": "You are an expert in Indian retail economics and kirana store cash flow management. Return only valid JSON."},
-                        {"role": "user", "content": CRITIC_PROMPT.format(
-                            pincode=pincode,
-                            presenter_output=json.dumps(presenter_output, indent=2)[:2000],
-                            vision_data=json.dumps(vision_data, indent=2)[:1500]
-                        )}
-                    ],
-                    "temperature": 0.3, "max_tokens": 1500
-                }
-            )
-            if r.status_code == 200:
-                content = r.json()["choices"][0]["message"]["content"]
-                parsed = _parse_json(content)
-                return {"agent": "GPT-4o Mini", "model": "gpt-4o-mini", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 80)}
+        r = await http.client.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={"Authorization": f"Bearer {settings.OPENAI_API_KEY}", "Content-Type": "application/json"},
+            json={
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {"role": "system", "content": "You are an expert in Indian retail economics and kirana store cash flow management. Return only valid JSON."},
+                    {"role": "user", "content": _critic_prompt(
+                        pincode=pincode,
+                        presenter_output=presenter_json[:2000],
+                        vision_data=vision_json[:1500]
+                    )}
+                ],
+                "temperature": 0.3, "max_tokens": 1500,
+                "response_format": {"type": "json_object"}
+            }
+        )
+        if r.status_code == 200:
+            content = r.json()["choices"][0]["message"]["content"]
+            parsed = _parse_json(content)
+            return {"agent": "GPT-4o Mini", "model": "gpt-4o-mini", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 80)}
     except Exception as e:
         print(f"GPT-4o critic failed: {e}")
     return None
 
 
-async def run_critic_groq(presenter_output: dict, vision_data: dict, pincode: str) -> Optional[dict]:
+async def run_critic_groq(presenter_json: str, vision_json: str, pincode: str) -> Optional[dict]:
     """CRITIC — Groq LLaMA-3.1-70B (free, ultra-fast)"""
     if not settings.GROQ_API_KEY:
         return None
     try:
-        async with httpx.AsyncClient(timeout=25) as c:
-            r = await c.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={"Authorization": f"Bearer {settings.GROQ_API_KEY}", "Content-Type": "application/json"},
-                json={
-                    "model": "llama-3.1-70b-versatile",
-                    "messages": [
-                        {"role": "system", "content": "You are an expert in Indian kirana retail economics. Return only valid JSON."},
-                        {"role": "user", "content": CRITIC_PROMPT.format(
-                            pincode=pincode,
-                            presenter_output=json.dumps(presenter_output, indent=2)[:2000],
-                            vision_data=json.dumps(vision_data, indent=2)[:1500]
-                        )}
-                    ],
-                    "temperature": 0.3, "max_tokens": 1500
-                }
-            )
-            if r.status_code == 200:
-                content = r.json()["choices"][0]["message"]["content"]
-                parsed = _parse_json(content)
-                return {"agent": "Groq LLaMA-3.1-70B", "model": "llama-3.1-70b-versatile", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 76)}
+        r = await http.client.post(
+            "https://api.groq.com/openai/v1/chat/completions",
+            headers={"Authorization": f"Bearer {settings.GROQ_API_KEY}", "Content-Type": "application/json"},
+            timeout=25,
+            json={
+                "model": "llama-3.1-70b-versatile",
+                "messages": [
+                    {"role": "system", "content": "You are an expert in Indian kirana retail economics. Return only valid JSON."},
+                    {"role": "user", "content": _critic_prompt(
+                        pincode=pincode,
+                        presenter_output=presenter_json[:2000],
+                        vision_data=vision_json[:1500]
+                    )}
+                ],
+                "temperature": 0.3, "max_tokens": 1500,
+                "response_format": {"type": "json_object"}
+            }
+        )
+        if r.status_code == 200:
+            content = r.json()["choices"][0]["message"]["content"]
+            parsed = _parse_json(content)
+            return {"agent": "Groq LLaMA-3.1-70B", "model": "llama-3.1-70b-versatile", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 76)}
     except Exception as e:
         print(f"Groq critic failed: {e}")
     return None
 
 
-async def run_critic_together(presenter_output: dict, vision_data: dict, pincode: str) -> Optional[dict]:
+async def run_critic_together(presenter_json: str, vision_json: str, pincode: str) -> Optional[dict]:
     """CRITIC — Together AI Mixtral-8x7B (free tier)"""
     if not settings.TOGETHER_API_KEY:
         return None
     try:
-        async with httpx.AsyncClient(timeout=30) as c:
-            r = await c.post(
-                "https://api.together.xyz/v1/chat/completions",
-                headers={"Authorization": f"Bearer {settings.TOGETHER_API_KEY}", "Content-Type": "application/json"},
-                json={
-                    "model": "mistralai/Mixtral-8x7B-Instruct-v0.1",
-                    "messages": [{"role": "user", "content": CRITIC_PROMPT.format(
-                        pincode=pincode,
-                        presenter_output=json.dumps(presenter_output, indent=2)[:2000],
-                        vision_data=json.dumps(vision_data, indent=2)[:1500]
-                    )}],
-                    "temperature": 0.3, "max_tokens": 1500
-                }
-            )
-            if r.status_code == 200:
-                content = r.json()["choices"][0]["message"]["content"]
-                parsed = _parse_json(content)
-                return {"agent": "Together Mixtral-8x7B", "model": "mixtral-8x7b-instruct", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 74)}
+        r = await http.client.post(
+            "https://api.together.xyz/v1/chat/completions",
+            headers={"Authorization": f"Bearer {settings.TOGETHER_API_KEY}", "Content-Type": "application/json"},
+            json={
+                "model": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+                "messages": [{"role": "user", "content": _critic_prompt(
+                    pincode=pincode,
+                    presenter_output=presenter_json[:2000],
+                    vision_data=vision_json[:1500]
+                )}],
+                "temperature": 0.3, "max_tokens": 1500
+            }
+        )
+        if r.status_code == 200:
+            content = r.json()["choices"][0]["message"]["content"]
+            parsed = _parse_json(content)
+            return {"agent": "Together Mixtral-8x7B", "model": "mixtral-8x7b-instruct", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 74)}
     except Exception as e:
         print(f"Together AI critic failed: {e}")
     return None
 
 
-async def run_critic_gemini_fallback(presenter_output: dict, vision_data: dict, pincode: str) -> dict:
+async def run_critic_gemini_fallback(presenter_json: str, vision_json: str, pincode: str) -> dict:
     """CRITIC — Gemini Flash fallback (always available)"""
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        resp = model.generate_content(
-            CRITIC_PROMPT.format(pincode=pincode, presenter_output=json.dumps(presenter_output, indent=2)[:2000], vision_data=json.dumps(vision_data, indent=2)[:1500]),
-            generation_config=genai.GenerationConfig(temperature=0.3, max_output_tokens=1500)
+        resp = await _FLASH_MODEL.generate_content_async(
+            _critic_prompt(pincode=pincode, presenter_output=presenter_json[:2000], vision_data=vision_json[:1500]),
+            generation_config=genai.GenerationConfig(temperature=0.3, max_output_tokens=1500, response_mime_type="application/json")
         )
         parsed = _parse_json(resp.text)
         return {"agent": "Gemini Flash (Critic Fallback)", "model": "gemini-1.5-flash", "type": "critic", "output": parsed, "confidence": parsed.get("confidence_score", 70)}
@@ -216,18 +223,17 @@ async def run_critic_gemini_fallback(presenter_output: dict, vision_data: dict,
         return {"agent": "Gemini Flash (Critic Fallback)", "model": "gemini-1.5-flash", "type": "critic", "output": {"accepted": [], "challenged": [], "rejected": [], "minimum_viable_restock": [], "risk_level": "medium", "confidence_score": 55, "critique_summary": "Fallback critique"}, "confidence": 55, "error": str(e)}
 
 
-async def run_decider(presenter_output: dict, critic_output: dict, vision_data: dict, store_info: dict) -> dict:
+async def run_decider(presenter_json: str, critic_output: dict, vision_data: dict, store_info: dict, vision_json: str) -> dict:
     """DECIDER — Gemini 1.5 Pro (final synthesis + Hindi voice)"""
     try:
-        model = genai.GenerativeModel("gemini-1.5-pro")
-        resp = model.generate_content(
-            DECIDER_PROMPT.format(
+        resp = await _PRO_MODEL.generate_content_async(
+            _decider_prompt(
                 language=store_info.get("primary_language", "hindi"),
-                presenter_output=json.dumps(presenter_output, indent=2)[:1800],
-                critic_output=json.dumps(critic_output, indent=2)[:1800],
-                vision_data=json.dumps(vision_data, indent=2)[:1200]
+                presenter_output=presenter_json[:1800],
+                critic_output=orjson.dumps(critic_output).decode()[:1800],
+                vision_data=vision_json[:1200]
             ),
-            generation_config=genai.GenerationConfig(temperature=0.2, max_output_tokens=2500)
+            generation_config=genai.GenerationConfig(temperature=0.2, max_output_tokens=2500, response_mime_type="application/json")
         )
         parsed = _parse_json(resp.text)
         return {"agent": "Gemini 1.5 Pro", "model": "gemini-1.5-pro", "type": "decider", "output": parsed, "final_hindi_text": parsed.get("final_hindi_text", ""), "confidence": parsed.get("confidence_score", 90)}
@@ -239,58 +245,46 @@ async def run_decider(presenter_output: dict, critic_output: dict, vision_data:
 async def run_ai_debate(vision_data: dict, store_info: dict, pincode: str) -> dict:
     """
     Full 3-agent debate pipeline.
-    Critic priority: GPT-4o Mini → Groq LLaMA-3.1 → Together Mixtral → Gemini Flash
+    Critic: first of GPT-4o Mini / Groq LLaMA-3.1 / Together Mixtral to answer, else Gemini Flash
     """
     rounds = []
     agents_used = []
 
     # ── Round 1: PRESENTER ──
     print("🎤 Presenter (Gemini 1.5 Pro) running...")
-    p = await run_presenter(vision_data, store_info)
+    vision_json = orjson.dumps(vision_data).decode()
+    p = await run_presenter(vision_data, store_info, vision_json)
     agents_used.append(p["agent"])
     rounds.append({
         "agent": p["agent"], "model": p["model"], "type": "presenter",
-        "output": json.dumps(p["output"]) if isinstance(p["output"], dict) else str(p["output"]),
+        "output": orjson.dumps(p["output"]).decode() if isinstance(p["output"], dict) else str(p["output"]),
         "reasoning": "Gemini 1.5 Pro vision-context analysis",
         "confidence_score": p["confidence"]
     })
 
     # ── Round 2: CRITIC ──
-    critic = None
-    if settings.OPENAI_API_KEY:
-        print("⚖️ Critic (GPT-4o Mini) running...")
-        critic = await run_critic_gpt4o(p["output"], vision_data, pincode)
-        if critic: print("✓ GPT-4o critic succeeded")
-
-    if not critic and settings.GROQ_API_KEY:
-        print("⚖️ Critic (Groq LLaMA-3.1) running...")
-        critic = await run_critic_groq(p["output"], vision_data, pincode)
-        if critic: print("✓ Groq critic succeeded")
-
-    if not critic and settings.TOGETHER_API_KEY:
-        print("⚖️ Critic (Together Mixtral) running...")
-        critic = await run_critic_together(p["output"], vision_data, pincode)
-        if critic: print("✓ Together AI critic succeeded")
+    presenter_json = orjson.dumps(p["output"]).decode()
+    critic = await _race_critics(presenter_json, vision_json, pincode)
 
     if not critic:
         print("⚖️ Critic (Gemini Flash fallback) running...")
-        critic = await run_critic_gemini_fallback(p["output"], vision_data, pincode)
+        critic = await run_critic_gemini_fallback(presenter_json, vision_json, pincode)
 
     agents_used.append(critic["agent"])
     rounds.append({
         "agent": critic["agent"], "model": critic["model"], "type": "critic",
-        "output": json.dumps(critic["output"]) if isinstance(critic["output"], dict) else str(critic["output"]),
+        "output": orjson.dumps(critic["output"]).decode() if isinstance(critic["output"], dict) else str(critic["output"]),
         "reasoning": "Economic stress-test of Presenter's plan",
         "confidence_score": critic["confidence"]
     })
 
     # ── Round 3: DECIDER ──
     print("🎯 Decider (Gemini 1.5 Pro) running...")
-    d = await run_decider(p["output"], critic["output"], vision_data, store_info)
+    d = await run_decider(presenter_json, critic["output"], vision_data, store_info, vision_json)
     agents_used.append(d["agent"])
     rounds.append({
         "agent": d["agent"], "model": d["model"], "type": "decider",
-        "output": json.dumps(d["output"]) if isinstance(d["output"], dict) else str(d["output"]),
+        "output": orjson.dumps(d["output"]).decode() if isinstance(d["output"], dict) else str(d["output"]),
         "reasoning": "Final synthesis of Presenter + Critic debate",
         "confidence_score": d["confidence"]
     })
@@ -308,19 +302,66 @@ async def run_ai_debate(vision_data: dict, store_info: dict, pincode: str) -> di
     return {"rounds": rounds, "final_recommendation": final_hindi, "presenter": p["output"], "critic": critic["output"], "decider": d["output"], "agents_used": agents_used, "critic_model_used": critic["model"]}
 
 
+async def _race_critics(presenter_json: str, vision_json: str, pincode: str) -> Optional[dict]:
+    """Run every configured critic concurrently and return the first usable response."""
+    critics = [
+        (settings.OPENAI_API_KEY, run_critic_gpt4o, "GPT-4o Mini"),
+        (settings.GROQ_API_KEY, run_critic_groq, "Groq LLaMA-3.1"),
+        (settings.TOGETHER_API_KEY, run_critic_together, "Together Mixtral"),
+    ]
+    tasks = {}
+    for api_key, run_critic, label in critics:
+        if api_key:
+            print(f"⚖️ Critic ({label}) running...")
+            tasks[asyncio.create_task(run_critic(presenter_json, vision_json, pincode))] = label
+
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None and task.result():
+                    print(f"✓ {tasks[task]} critic succeeded")
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    return None
+
+
 def _parse_json(text: str) -> dict:
-    text = re.sub(r"```json\n?", "", text.strip())
-    text = re.sub(r"```\n?", "", text).strip()
+    text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
     try:
-        return json.loads(text)
+        return orjson.loads(text)
     except:
-        m = re.search(r'\{.*\}', text, re.DOTALL)
-        if m:
-            try: return json.loads(m.group())
+        obj = _first_json_object(text)
+        if obj is not None:
+            try: return orjson.loads(obj)
             except: pass
     return {"raw": text[:500], "parse_error": True}
 
 
+def _first_json_object(text: str) -> Optional[str]:
+    """Linear scan for the first balanced {...} block, skipping braces inside strings."""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth, in_str, escaped = 0, False, False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if escaped: escaped = False
+            elif c == "\\": escaped = True
+            elif c == '"': in_str = False
+        elif c == '"': in_str = True
+        elif c == "{": depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
 def _fallback_presenter(vision_data: dict) -> dict:
     products = vision_data.get("products", [])
     urgents = [p for p in products if p.get("stock_level") in ["critical", "low"]]
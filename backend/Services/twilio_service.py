@@ -14,21 +14,34 @@ Webhook URL to configure in Twilio Console:
   Method: HTTP POST
 """
 
-import httpx
+from functools import lru_cache
 from typing import Optional
 from config import settings
+from http_client import http
 
 
 TWILIO_API_URL = "https://api.twilio.com/2010-04-01"
 
+# Media downloads are read in chunks straight into one buffer
+MEDIA_CHUNK_SIZE = 64 * 1024
 
-async def download_media(media_url: str, account_sid: str, auth_token: str) -> bytes:
-    """Download media from Twilio (requires Basic Auth)"""
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(media_url, auth=(account_sid, auth_token))
+
+@lru_cache(maxsize=8)
+def _messages_url(account_sid: str) -> str:
+    return f"{TWILIO_API_URL}/Accounts/{account_sid}/Messages.json"
+
+
+async def download_media(media_url: str, account_sid: str, auth_token: str) -> bytearray:
+    """Download media from Twilio (requires Basic Auth), streamed into a single buffer"""
+    async with http.client.stream(
+        "GET", media_url, auth=(account_sid, auth_token), timeout=30
+    ) as r:
         if r.status_code != 200:
             raise Exception(f"Failed to download media: {r.status_code}")
-        return r.content
+        buf = bytearray()
+        async for chunk in r.aiter_bytes(MEDIA_CHUNK_SIZE):
+            buf.extend(chunk)
+        return buf
 
 
 async def send_whatsapp_text(
@@ -39,17 +52,17 @@ async def send_whatsapp_text(
     auth_token: str
 ) -> dict:
     """Send a WhatsApp text message via Twilio"""
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{TWILIO_API_URL}/Accounts/{account_sid}/Messages.json",
-            auth=(account_sid, auth_token),
-            data={
-                "From": f"whatsapp:{from_number}",
-                "To": f"whatsapp:{to}",
-                "Body": body,
-            }
-        )
-        return r.json()
+    r = await http.client.post(
+        _messages_url(account_sid),
+        auth=(account_sid, auth_token),
+        data={
+            "From": f"whatsapp:{from_number}",
+            "To": f"whatsapp:{to}",
+            "Body": body,
+        },
+        timeout=20
+    )
+    return r.json()
 
 
 async def send_whatsapp_media(
@@ -61,18 +74,18 @@ async def send_whatsapp_media(
     auth_token: str
 ) -> dict:
     """Send a WhatsApp message with audio/media attachment via Twilio"""
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{TWILIO_API_URL}/Accounts/{account_sid}/Messages.json",
-            auth=(account_sid, auth_token),
-            data={
-                "From": f"whatsapp:{from_number}",
-                "To": f"whatsapp:{to}",
-                "Body": body,
-                "MediaUrl": media_url,
-            }
-        )
-        return r.json()
+    r = await http.client.post(
+        _messages_url(account_sid),
+        auth=(account_sid, auth_token),
+        data={
+            "From": f"whatsapp:{from_number}",
+            "To": f"whatsapp:{to}",
+            "Body": body,
+            "MediaUrl": media_url,
+        },
+        timeout=20
+    )
+    return r.json()
 
 
 def build_processing_twiml() -> str:
@@ -3,14 +3,41 @@ ShelfScan AI - Gemini Vision Service
 Analyzes shelf images using Google Gemini 1.5 Pro Vision
 Returns structured JSON with product detection, stock levels, facing analysis
 """
+import asyncio
 import google.generativeai as genai
-import json
-import base64
+import hashlib
+import io
+import orjson
 import re
+from typing import Union
+from PIL import Image, ImageStat
 from config import settings
+from database import db
+from services.cloudinary_service import fit_image
 
 genai.configure(api_key=settings.GEMINI_API_KEY)
 
+_VISION_MODEL = genai.GenerativeModel(
+    "gemini-1.5-pro",
+    generation_config=genai.GenerationConfig(
+        temperature=0.1,  # Low temp for accurate detection
+        max_output_tokens=4096
+    )
+)
+
+# Gemini tiles images well below phone-camera resolution; anything larger is wasted upload
+VISION_MAX_SIDE = 1024
+# Photos under this size are sent as-is
+VISION_RESIZE_MIN_BYTES = 256 * 1024
+
+# Photos darker than this mean luminance (0-255), or flatter than this spread, are not worth a Gemini call
+DARK_MEAN_THRESHOLD = 20
+BLANK_STDDEV_THRESHOLD = 4
+
+# Markdown code fences (with or without a json tag) and the outermost {...} in a reply
+_FENCE = re.compile(r"```(?:json)?\n?")
+_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+
 
 VISION_PROMPT = """
 You are ShelfScan AI Vision — an expert retail shelf analyst for Indian kirana stores.
@@ -68,45 +95,54 @@ Return ONLY valid JSON in this exact structure (no markdown, no explanation):
 """
 
 
-async def analyze_shelf_image(image_url: str, image_bytes: bytes) -> dict:
+async def analyze_shelf_image(image_url: str, image_bytes: Union[bytes, bytearray]) -> dict:
     """
     Use Gemini 1.5 Pro Vision to analyze a kirana shelf image
     Returns structured product detection data
     """
+    # Pocket shots and blank frames are flagged so the caller can ask for a retake
+    if await asyncio.to_thread(_is_unusable_photo, image_bytes):
+        return {
+            **_fallback_vision_data(image_url),
+            "raw_observations": "Photo too dark or blank - please retake",
+            "unusable_photo": True
+        }
+
+    # Retried / duplicate deliveries of the same photo skip Gemini entirely
+    key = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    cached = await _cached_vision(key)
+    if cached is not None:
+        return {**cached, "image_url": image_url}
+
     try:
-        model = genai.GenerativeModel("gemini-1.5-pro")
+        image_bytes = await asyncio.to_thread(_shrink_for_vision, image_bytes)
+        if not isinstance(image_bytes, bytes):
+            image_bytes = bytes(image_bytes)
 
-        # Convert bytes to base64 for Gemini
+        # The SDK takes raw bytes as an inline blob; no base64 round-trip needed
         image_data = {
             "mime_type": "image/jpeg",
-            "data": base64.b64encode(image_bytes).decode("utf-8")
+            "data": image_bytes
         }
 
-        response = model.generate_content(
-            [VISION_PROMPT, image_data],
-            generation_config=genai.GenerationConfig(
-                temperature=0.1,  # Low temp for accurate detection
-                max_output_tokens=4096
-            )
-        )
+        response = await _VISION_MODEL.generate_content_async([VISION_PROMPT, image_data])
 
         raw_text = response.text.strip()
 
         # Clean JSON from response (remove markdown if present)
-        raw_text = re.sub(r"```json\n?", "", raw_text)
-        raw_text = re.sub(r"```\n?", "", raw_text)
-        raw_text = raw_text.strip()
+        raw_text = _FENCE.sub("", raw_text).strip()
 
-        vision_data = json.loads(raw_text)
+        vision_data = orjson.loads(raw_text)
+        await _cache_vision(key, vision_data)
         vision_data["image_url"] = image_url
         return vision_data
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         # Fallback: try to extract JSON from response
         try:
-            json_match = re.search(r"\{.*\}", raw_text, re.DOTALL)
+            json_match = _JSON_OBJECT.search(raw_text)
             if json_match:
-                return json.loads(json_match.group())
+                return orjson.loads(json_match.group())
         except:
             pass
         # Return minimal valid structure
@@ -116,6 +152,45 @@ async def analyze_shelf_image(image_url: str, image_bytes: bytes) -> dict:
         raise Exception(f"Gemini Vision analysis failed: {str(e)}")
 
 
+def _is_unusable_photo(image_bytes: Union[bytes, bytearray]) -> bool:
+    """True for near-black or featureless images; undecodable input is left for Gemini to judge"""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft("L", (64, 64))  # JPEGs decode straight to a small grayscale image
+        stat = ImageStat.Stat(img.convert("L").resize((32, 32)))
+        return stat.mean[0] < DARK_MEAN_THRESHOLD or stat.stddev[0] < BLANK_STDDEV_THRESHOLD
+    except Exception:
+        return False
+
+
+def _shrink_for_vision(image_bytes: Union[bytes, bytearray]) -> Union[bytes, bytearray]:
+    """Fit the photo inside VISION_MAX_SIDE and re-encode as JPEG; returns the input if small or undecodable"""
+    if len(image_bytes) < VISION_RESIZE_MIN_BYTES:
+        return image_bytes
+    return fit_image(image_bytes, (VISION_MAX_SIDE, VISION_MAX_SIDE))
+
+
+async def _cached_vision(key: str):
+    """Parsed vision JSON for an image hash, or None on miss / lookup failure"""
+    try:
+        result = await db.execute(
+            db.client.table("vision_cache").select("data").eq("hash", key).limit(1)
+        )
+        return result.data[0]["data"] if result.data else None
+    except Exception as e:
+        print(f"Vision cache lookup failed: {e}")
+        return None
+
+
+async def _cache_vision(key: str, vision_data: dict):
+    try:
+        await db.execute(
+            db.client.table("vision_cache").upsert({"hash": key, "data": vision_data})
+        )
+    except Exception as e:
+        print(f"Vision cache write failed: {e}")
+
+
 def _fallback_vision_data(image_url: str) -> dict:
     """Fallback structure if vision parsing fails"""
     return {
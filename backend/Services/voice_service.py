@@ -3,11 +3,30 @@ ShelfScan AI - ElevenLabs Hindi Voice Note Service
 Converts Decider's Hindi text to natural voice note
 Uploads to Cloudinary and returns URL
 """
-import httpx
+import hashlib
 import io
+from collections import OrderedDict
+from typing import AsyncIterator
 from config import settings
+from database import db
+from http_client import http
+from tasks import spawn
 from services.cloudinary_service import upload_audio  # noqa: E402
 
+# Settings are frozen, so the ElevenLabs endpoint is built once
+_EL_KEY = settings.ELEVENLABS_API_KEY
+_EL_VOICE = settings.ELEVENLABS_VOICE_ID
+_EL_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{_EL_VOICE}/stream"
+
+# Raw MP3s kept in-process for generate_voice_direct
+DIRECT_CACHE_SIZE = 256
+_direct_cache = OrderedDict()
+
+
+def _tts_key(hindi_text: str) -> str:
+    """Cache key for a synthesized clip: same voice + same text → same audio"""
+    return hashlib.sha256((_EL_VOICE + "|" + hindi_text).encode()).hexdigest()
+
 
 async def generate_hindi_voice(hindi_text: str, store_name: str, scan_id: str) -> tuple[str, int]:
     """
@@ -15,40 +34,38 @@ async def generate_hindi_voice(hindi_text: str, store_name: str, scan_id: str) -
     Returns (audio_url, duration_seconds)
     """
     try:
-        # ElevenLabs TTS API
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.post(
-                f"https://api.elevenlabs.io/v1/text-to-speech/{settings.ELEVENLABS_VOICE_ID}",
-                headers={
-                    "xi-api-key": settings.ELEVENLABS_API_KEY,
-                    "Content-Type": "application/json",
-                    "Accept": "audio/mpeg"
-                },
-                json={
-                    "text": hindi_text,
-                    "model_id": "eleven_multilingual_v2",  # Supports Hindi
-                    "voice_settings": {
-                        "stability": 0.6,
-                        "similarity_boost": 0.8,
-                        "style": 0.3,
-                        "use_speaker_boost": True
-                    }
-                }
+        key = _tts_key(hindi_text)
+        # Repeated Decider phrasing reuses the clip already on Cloudinary
+        try:
+            cached = await db.execute(
+                db.client.table("tts_cache").select("audio_url, duration_seconds").eq("hash", key).limit(1)
             )
+            if cached.data:
+                return cached.data[0]["audio_url"], cached.data[0]["duration_seconds"]
+        except Exception as e:
+            print(f"TTS cache lookup failed: {e}")
 
+        # ElevenLabs TTS API — streamed so audio accumulates while it's still being synthesized
+        audio_bytes = bytearray()
+        async with _tts_stream(hindi_text) as response:
             if response.status_code != 200:
+                await response.aread()
                 raise Exception(f"ElevenLabs API error: {response.status_code} - {response.text}")
+            async for chunk in response.aiter_bytes():
+                audio_bytes.extend(chunk)
 
-            audio_bytes = response.content
+        # Estimate duration (roughly 150 words per minute for Hindi speech)
+        word_count = len(hindi_text.split())
+        estimated_seconds = max(5, int((word_count / 150) * 60))
 
-            # Estimate duration (roughly 150 words per minute for Hindi speech)
-            word_count = len(hindi_text.split())
-            estimated_seconds = max(5, int((word_count / 150) * 60))
+        # Upload to Cloudinary
+        audio_url = await upload_audio(audio_bytes, scan_id)
 
-            # Upload to Cloudinary
-            audio_url = await upload_audio(audio_bytes, scan_id)
+        if audio_url:
+            # The caller only needs the URL; the cache row is written alongside the reply
+            spawn(_remember_clip(key, audio_url, estimated_seconds))
 
-            return audio_url, estimated_seconds
+        return audio_url, estimated_seconds
 
     except Exception as e:
         # Return placeholder if voice generation fails
@@ -56,30 +73,61 @@ async def generate_hindi_voice(hindi_text: str, store_name: str, scan_id: str) -
         return "", 0
 
 
-async def generate_voice_direct(hindi_text: str) -> bytes:
-    """Generate voice and return raw bytes (for streaming)"""
+async def _remember_clip(key: str, audio_url: str, duration_seconds: int):
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.post(
-                f"https://api.elevenlabs.io/v1/text-to-speech/{settings.ELEVENLABS_VOICE_ID}",
-                headers={
-                    "xi-api-key": settings.ELEVENLABS_API_KEY,
-                    "Content-Type": "application/json",
-                    "Accept": "audio/mpeg"
-                },
-                json={
-                    "text": hindi_text,
-                    "model_id": "eleven_multilingual_v2",
-                    "voice_settings": {
-                        "stability": 0.6,
-                        "similarity_boost": 0.8,
-                        "style": 0.3,
-                        "use_speaker_boost": True
-                    }
-                }
-            )
-            if response.status_code == 200:
-                return response.content
-            return b""
-    except:
-        return b""
+        await db.execute(
+            db.client.table("tts_cache").upsert({
+                "hash": key,
+                "audio_url": audio_url,
+                "duration_seconds": duration_seconds
+            })
+        )
+    except Exception as e:
+        print(f"TTS cache write failed: {e}")
+
+
+async def generate_voice_direct(hindi_text: str) -> AsyncIterator[bytes]:
+    """Generate voice and yield MP3 chunks as ElevenLabs produces them (for streaming)"""
+    key = _tts_key(hindi_text)
+    if key in _direct_cache:
+        _direct_cache.move_to_end(key)
+        yield _direct_cache[key]
+        return
+    try:
+        audio = bytearray()
+        async with _tts_stream(hindi_text) as response:
+            if response.status_code != 200:
+                return
+            async for chunk in response.aiter_bytes():
+                audio.extend(chunk)
+                yield chunk
+        # Only complete clips are cached
+        _direct_cache[key] = bytes(audio)
+        if len(_direct_cache) > DIRECT_CACHE_SIZE:
+            _direct_cache.popitem(last=False)
+    except Exception:
+        return
+
+
+def _tts_stream(hindi_text: str):
+    """Open a streaming ElevenLabs TTS request; use as an async context manager"""
+    return http.client.stream(
+        "POST",
+        _EL_URL,
+        headers={
+            "xi-api-key": _EL_KEY,
+            "Content-Type": "application/json",
+            "Accept": "audio/mpeg"
+        },
+        json={
+            "text": hindi_text,
+            "model_id": "eleven_multilingual_v2",  # Supports Hindi
+            "voice_settings": {
+                "stability": 0.6,
+                "similarity_boost": 0.8,
+                "style": 0.3,
+                "use_speaker_boost": True
+            }
+        },
+        timeout=60
+    )
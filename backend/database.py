@@ -1,3 +1,4 @@
+import asyncio
 from supabase import create_client, Client
 from config import settings
 
@@ -12,5 +13,9 @@ class Database:
     def get_client(self) -> Client:
         return self.client
 
+    async def execute(self, query):
+        """Run a blocking supabase-py query on a worker thread so it can overlap other awaits"""
+        return await asyncio.to_thread(query.execute)
+
 
 db = Database()
@@ -0,0 +1,17 @@
+"""ShelfScan AI — Shared HTTP client (Twilio, ElevenLabs, LLM critics)"""
+import httpx
+
+
+class HttpClient:
+    def __init__(self):
+        # One keep-alive pool for the whole process so outbound calls skip the TCP/TLS handshake
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30),
+            limits=httpx.Limits(max_connections=128, max_keepalive_connections=64, keepalive_expiry=60)
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+
+http = HttpClient()
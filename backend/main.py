@@ -1,18 +1,24 @@
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response
 import uvicorn
 import os
-import json
+import orjson
 import base64
 import asyncio
 import io
-from typing import Optional
+import time
+from typing import Optional, Union
 from datetime import datetime
+from xml.sax.saxutils import escape
+from collections import Counter, defaultdict, deque
+from contextlib import asynccontextmanager
 
 from config import settings
 from database import db
+from http_client import http
+from tasks import spawn
 from services.cloudinary_service import upload_image
 from services.vision_service import analyze_shelf_image
 from services.debate_service import run_ai_debate
@@ -26,7 +32,8 @@ from models import StoreRegister, ScanRequest
 app = FastAPI(
     title="ShelfScan AI API",
     description="AI Shelf Intelligence for Kirana Stores",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -37,30 +44,82 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Sent instead of a report when vision flags the photo as too dark or blank
+RETAKE_MESSAGE = (
+    "📸 Photo bahut dark ya blank hai — shelf dikh nahi rahi.\n"
+    "Achhi roshni mein shelf ki saaf photo dobara bhejiye."
+)
+
+# Dashboards are polled heavily and tolerate a few seconds of staleness
+DASHBOARD_TTL_SECONDS = 15
+_dashboard_cache = {}  # store_id -> (expires_at, payload)
+_dashboard_locks = defaultdict(asyncio.Lock)
+
+# Ring buffer of recent (stage, seconds) pipeline timings, served by /debug/aioprof
+PROFILE_BUFFER_SIZE = 1000
+_stage_timings = deque(maxlen=PROFILE_BUFFER_SIZE)
+
+# whatsapp_messages rows are buffered and written as multi-row inserts
+WA_LOG_BATCH_SIZE = 50
+WA_LOG_FLUSH_SECONDS = 0.5
+WA_LOG_COLUMNS = ("store_id", "whatsapp_number", "direction", "message_type",
+                  "message_content", "media_url", "status", "created_at")
+_wa_log_buffer = []
+_wa_log_timer = None
+
+# Encoded-text defaults for the JSON columns
+EMPTY_JSON_LIST = "[]"
+EMPTY_JSON_OBJ = "{}"
+
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await _flush_wa_log()
+    await http.close()
+
+
+ROOT_STATUS = {"status": "ShelfScan AI running", "version": "1.0.0"}
+
+# /health timestamp is re-rendered at most once per second
+_health_stamp = (0, "")
 
 
 @app.get("/")
 async def root():
-    return {"status": "ShelfScan AI running", "version": "1.0.0"}
+    return ROOT_STATUS
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "timestamp": datetime.utcnow().isoformat()}
+    global _health_stamp
+    now_sec = int(time.time())
+    if now_sec != _health_stamp[0]:
+        _health_stamp = (now_sec, datetime.utcfromtimestamp(now_sec).isoformat())
+    return {"status": "ok", "timestamp": _health_stamp[1]}
+
+
+@app.get("/debug/aioprof")
+async def aioprof():
+    """Wall-clock per pipeline stage, awaits included (only when DEBUG=1 is set in the environment)"""
+    if not settings.DEBUG:
+        raise HTTPException(status_code=404, detail="Not Found")
+    by_stage = defaultdict(list)
+    for stage, seconds in _stage_timings:
+        by_stage[stage].append(seconds)
+    return {
+        stage: {
+            "count": len(samples),
+            "avg_ms": round(sum(samples) / len(samples) * 1000, 1),
+            "max_ms": round(max(samples) * 1000, 1)
+        }
+        for stage, samples in by_stage.items()
+    }
 
 
 @app.post("/api/stores/register")
 async def register_store(data: StoreRegister):
     """Register a new kirana store owner"""
     try:
-        # Check if already registered
-        existing = db.client.table("stores") \
-            .select("id") \
-            .eq("whatsapp_number", data.whatsapp_number) \
-            .execute()
-
-        if existing.data:
-            raise HTTPException(status_code=409, detail="WhatsApp number already registered")
-
         store_data = {
             **data.dict(),
             "registered_at": datetime.utcnow().isoformat(),
@@ -69,7 +128,14 @@ async def register_store(data: StoreRegister):
             "shelf_health_score": 0
         }
 
-        result = db.client.table("stores").insert(store_data).execute()
+        # whatsapp_number is UNIQUE; a conflict comes back as an empty result
+        result = db.client.table("stores") \
+            .upsert(store_data, on_conflict="whatsapp_number", ignore_duplicates=True) \
+            .execute()
+
+        if not result.data:
+            raise HTTPException(status_code=409, detail="WhatsApp number already registered")
+
         store = result.data[0]
 
        
@@ -91,10 +157,9 @@ async def register_store(data: StoreRegister):
 async def login_store(whatsapp: str):
     """Login / fetch store by WhatsApp number"""
     try:
-        clean = whatsapp.replace(" ", "").replace("-", "")
         result = db.client.table("stores") \
             .select("*") \
-            .eq("whatsapp_number", clean) \
+            .eq("whatsapp_number", _canonical_number(whatsapp)) \
             .execute()
 
         if not result.data:
@@ -128,173 +193,106 @@ async def scan_shelf(
 ):
     """
     Full ShelfScan AI Pipeline:
-    1. Upload image to Cloudinary
+    1. Upload image to Cloudinary (in the background)
     2. Gemini Vision analyzes shelf
     3. 3-Agent AI Debate (Presenter → Critic → Decider)
     4. Hindi Voice Note via ElevenLabs
     5. Save all to Supabase
     """
     try:
-        store_result = db.client.table("stores").select("*").eq("id", store_id).execute()
+        # One in-memory copy of the photo serves both vision and the background upload
+        store_result, image_bytes = await asyncio.gather(
+            db.execute(db.client.table("stores").select("*").eq("id", store_id)),
+            asyncio.to_thread(image.file.read)
+        )
         if not store_result.data:
             raise HTTPException(status_code=404, detail="Store not found")
         store = store_result.data[0]
 
-        image_bytes = await image.read()
-        image_url = await upload_image(image_bytes, store_id)
-
-        scan_record = {
-            "store_id": store_id,
-            "image_url": image_url,
-            "status": "processing",
-            "created_at": datetime.utcnow().isoformat()
-        }
-        scan_result = db.client.table("scans").insert(scan_record).execute()
-        scan_id = scan_result.data[0]["id"]
-
-        vision_data = await analyze_shelf_image(image_url, image_bytes)
-
-        if vision_data.get("products"):
-            products_to_insert = []
-            for p in vision_data["products"]:
-                products_to_insert.append({
-                    "scan_id": scan_id,
-                    "store_id": store_id,
-                    "product_name": p.get("name", "Unknown"),
-                    "brand": p.get("brand", ""),
-                    "category": p.get("category", "General"),
-                    "stock_level": p.get("stock_level", "ok"),
-                    "quantity_estimate": p.get("quantity", 0),
-                    "facing_correct": p.get("facing_correct", True),
-                    "shelf_position": p.get("shelf_position", ""),
-                    "detected_at": datetime.utcnow().isoformat()
-                })
-            db.client.table("detected_products").insert(products_to_insert).execute()
-
-        debate_result = await run_ai_debate(
-            vision_data=vision_data,
-            store_info=store,
-            pincode=store.get("pincode", "")
-        )
-
-        for round_data in debate_result["rounds"]:
-            db.client.table("debate_rounds").insert({
-                "scan_id": scan_id,
-                "agent_name": round_data["agent"],
-                "agent_type": round_data["type"],
-                "recommendation": round_data["output"],
-                "reasoning": round_data.get("reasoning", ""),
-                "created_at": datetime.utcnow().isoformat()
-            }).execute()
-
-        final_recommendation = debate_result["final_recommendation"]
-        voice_url, voice_duration = "", 0
-        try:
-            voice_url, voice_duration = await generate_hindi_voice(
-                final_recommendation,
-                store_name=store.get("store_name", ""),
-                scan_id=scan_id
-            )
-            print(f"✅ Voice note generated: {voice_url}")
-        except Exception as voice_err:
- 
-            print(f"❌ Voice generation failed: {voice_err}")
-
-
-        db.client.table("voice_notes").insert({
-            "scan_id": scan_id,
-            "store_id": store_id,
-            "audio_url": voice_url,
-            "duration_seconds": voice_duration,
-            "language": "hindi",
-            "text_content": final_recommendation,
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
-
-        health_score = _calculate_health_score(vision_data)
-        db.client.table("scans").update({
-            "status": "completed",
-            "shelf_health_score": health_score,
-            "products_detected": len(vision_data.get("products", [])),
-            "critical_items": vision_data.get("critical_count", 0),
-            "vision_summary": json.dumps(vision_data.get("summary", {})),
-            "final_recommendation": final_recommendation,
-            "voice_note_url": voice_url,
-            "completed_at": datetime.utcnow().isoformat()
-        }).eq("id", scan_id).execute()
-
-
-        db.client.table("stores").update({
-            "total_scans": (store.get("total_scans", 0) + 1),
-            "shelf_health_score": health_score,
-            "last_scan_at": datetime.utcnow().isoformat()
-        }).eq("id", store_id).execute()
-
-
-        await _update_neighborhood(store_id, store.get("pincode"), vision_data)
+        result = await _run_scan_pipeline(store, image_bytes)
 
         return {
             "success": True,
-            "scan_id": scan_id,
-            "image_url": image_url,
-            "vision_analysis": vision_data,
-            "debate_rounds": debate_result["rounds"],
-            "final_recommendation": final_recommendation,
-            "voice_note_url": voice_url,
-            "shelf_health_score": health_score,
-            "products_detected": len(vision_data.get("products", []))
+            "retake": result["retake"],
+            "scan_id": result["scan_id"],
+            "image_url": result["image_url"],
+            "vision_analysis": result["vision_data"],
+            "debate_rounds": result["debate_rounds"],
+            "final_recommendation": result["final_recommendation"],
+            "voice_note_url": result["voice_url"],
+            "shelf_health_score": result["health_score"],
+            "products_detected": len(result["vision_data"].get("products", []))
         }
 
     except HTTPException:
         raise
     except Exception as e:
-
-        try:
-            if 'scan_id' in locals():
-                db.client.table("scans").update({
-                    "status": "failed",
-                    "error_message": str(e)
-                }).eq("id", scan_id).execute()
-        except:
-            pass
         raise HTTPException(status_code=500, detail=f"Scan pipeline failed: {str(e)}")
 
 @app.get("/api/dashboard/{store_id}")
 async def get_dashboard(store_id: str):
-    """Get all dashboard data for a store"""
+    """Get all dashboard data for a store (cached per store for DASHBOARD_TTL_SECONDS)"""
+    cached = _dashboard_cache.get(store_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    # One rebuild per store at a time; concurrent pollers wait and reuse it
+    async with _dashboard_locks[store_id]:
+        cached = _dashboard_cache.get(store_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        try:
+            payload = await _build_dashboard(store_id)
+        except Exception:
+            # Only ids that produced a cache entry keep a lock; unknown or malformed ones must not
+            _dashboard_locks.pop(store_id, None)
+            raise
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in _dashboard_cache.items() if expires_at <= now]:
+            del _dashboard_cache[key]
+        _dashboard_cache[store_id] = (now + DASHBOARD_TTL_SECONDS, payload)
+        return payload
+
+
+async def _build_dashboard(store_id: str) -> dict:
     try:
         store_res = db.client.table("stores").select("*").eq("id", store_id).execute()
         if not store_res.data:
             raise HTTPException(status_code=404, detail="Store not found")
         store = store_res.data[0]
         scans_res = db.client.table("scans") \
-            .select("*") \
+            .select("id, image_url, status, shelf_health_score, products_detected, critical_items, "
+                    "final_recommendation, voice_note_url, created_at, completed_at") \
             .eq("store_id", store_id) \
             .order("created_at", desc=True) \
             .limit(20) \
             .execute()
 
         products_res = db.client.table("detected_products") \
-            .select("*") \
+            .select("id, scan_id, product_name, brand, category, stock_level, quantity_estimate, "
+                    "facing_correct, shelf_position, price_visible, detected_at") \
             .eq("store_id", store_id) \
             .order("detected_at", desc=True) \
             .limit(50) \
             .execute()
 
         voice_res = db.client.table("voice_notes") \
-            .select("*") \
+            .select("id, scan_id, audio_url, duration_seconds, language, text_content, delivered_via, created_at") \
             .eq("store_id", store_id) \
             .order("created_at", desc=True) \
             .limit(10) \
             .execute()
 
         neighborhood_res = db.client.table("neighborhood_demand") \
-            .select("*") \
+            .select("pincode, city, week_start, total_stores_scanned, top_categories, "
+                    "stockout_products, demand_signals, updated_at") \
             .eq("pincode", store.get("pincode", "")) \
             .order("week_start", desc=True) \
             .limit(10) \
             .execute()
 
+        distinct_res = db.client.rpc("count_distinct_products", {"p_store_id": store_id}).execute()
+
         competitors_res = db.client.table("stores") \
             .select("store_name, store_type, city, total_scans, shelf_health_score, last_scan_at") \
             .eq("pincode", store.get("pincode", "")) \
@@ -304,12 +302,8 @@ async def get_dashboard(store_id: str):
         all_scans = scans_res.data or []
         all_products = products_res.data or []
 
-        critical_items = [p for p in all_products if p.get("stock_level") == "critical"]
-        low_items = [p for p in all_products if p.get("stock_level") == "low"]
-        ok_items = [p for p in all_products if p.get("stock_level") == "ok"]
-        overstocked = [p for p in all_products if p.get("stock_level") == "overstocked"]
+        stock_counts = Counter(p.get("stock_level", "ok") for p in all_products)
 
-        from collections import defaultdict
         weekly = defaultdict(int)
         for scan in all_scans:
             try:
@@ -329,12 +323,12 @@ async def get_dashboard(store_id: str):
             "stats": {
                 "total_scans": len(all_scans),
                 "shelf_health_score": store.get("shelf_health_score", 0),
-                "critical_items": len(critical_items),
-                "low_stock_items": len(low_items),
-                "ok_items": len(ok_items),
-                "overstocked_items": len(overstocked),
+                "critical_items": stock_counts["critical"],
+                "low_stock_items": stock_counts["low"],
+                "ok_items": stock_counts["ok"],
+                "overstocked_items": stock_counts["overstocked"],
                 "avg_response_seconds": avg_response,
-                "total_products_tracked": len(set(p.get("product_name", "") for p in all_products))
+                "total_products_tracked": distinct_res.data or 0
             },
             "recent_scans": all_scans[:10],
             "current_products": all_products[:50],
@@ -423,6 +417,233 @@ async def get_voice_note(scan_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _run_scan_pipeline(store: dict, image_bytes: Union[bytes, bytearray],
+                             delivered_via: Optional[str] = None) -> dict:
+    """
+    Vision → Debate → Voice → Supabase, shared by /api/scan and the WhatsApp webhook.
+    The same image bytes feed Gemini and the background Cloudinary upload.
+    Marks the scan failed and re-raises if anything after its insert goes wrong.
+    """
+    store_id = store["id"]
+    now_iso = datetime.utcnow().isoformat()
+
+    # Cloudinary upload runs in the background; the URL is attached to the scan when it lands
+    scan_record = {
+        "store_id": store_id,
+        "image_url": "",
+        "pending_upload": True,
+        "status": "processing",
+        "created_at": now_iso
+    }
+    # Vision only needs the bytes, so the scan row is created while Gemini runs
+    async with _timed("vision"):
+        scan_result, vision_data = await asyncio.gather(
+            db.execute(db.client.table("scans").insert(scan_record)),
+            analyze_shelf_image("", image_bytes),
+            return_exceptions=True
+        )
+    if isinstance(scan_result, Exception):
+        raise scan_result
+    scan_id = scan_result.data[0]["id"]
+    upload_task = spawn(_upload_scan_image(image_bytes, store_id, scan_id))
+
+    try:
+        if isinstance(vision_data, Exception):
+            raise vision_data
+
+        # Nothing to debate on a dark or blank frame; skip the LLMs and TTS and ask for a retake
+        if vision_data.get("unusable_photo"):
+            await db.execute(db.client.table("scans").update({
+                "status": "failed",
+                "error_message": "Photo too dark or blank",
+                "completed_at": datetime.utcnow().isoformat()
+            }).eq("id", scan_id))
+            _dashboard_cache.pop(store_id, None)
+            return {
+                "scan_id": scan_id,
+                "retake": True,
+                "image_url": upload_task.result() if upload_task.done() else "",
+                "vision_data": vision_data,
+                "debate_rounds": [],
+                "final_recommendation": RETAKE_MESSAGE,
+                "voice_url": "",
+                "health_score": 0
+            }
+
+        products_to_insert = [
+            {
+                "scan_id": scan_id,
+                "store_id": store_id,
+                "product_name": p.get("name", p.get("product_name", "Unknown")),
+                "brand": p.get("brand", ""),
+                "category": p.get("category", "General"),
+                "stock_level": p.get("stock_level", "ok"),
+                "quantity_estimate": p.get("quantity", 0),
+                "facing_correct": p.get("facing_correct", True),
+                "shelf_position": p.get("shelf_position", ""),
+                "detected_at": now_iso
+            }
+            for p in vision_data.get("products") or []
+        ]
+
+        # Product rows are saved while the debate runs
+        async with _timed("debate"):
+            debate_result, _ = await asyncio.gather(
+                run_ai_debate(
+                    vision_data=vision_data,
+                    store_info=store,
+                    pincode=store.get("pincode", "")
+                ),
+                _insert_detected_products(products_to_insert)
+            )
+
+        # ElevenLabs starts as soon as the recommendation exists; the completion writes overlap it
+        final_recommendation = debate_result["final_recommendation"]
+        voice_task = asyncio.create_task(generate_hindi_voice(
+            final_recommendation,
+            store_name=store.get("store_name", ""),
+            scan_id=scan_id
+        ))
+        async with _timed("voice_and_writes"):
+            health_score, voice_url = await _complete_scan(
+                store, scan_id, vision_data, final_recommendation, debate_result["rounds"], voice_task,
+                delivered_via=delivered_via
+            )
+        if voice_url:
+            print(f"✅ Voice note generated: {voice_url}")
+        else:
+            print("❌ Voice generation failed")
+    except Exception as e:
+        try:
+            await db.execute(db.client.table("scans").update({
+                "status": "failed",
+                "error_message": str(e)
+            }).eq("id", scan_id))
+        except Exception:
+            pass
+        raise
+
+    return {
+        "scan_id": scan_id,
+        "retake": False,
+        "image_url": upload_task.result() if upload_task.done() else "",
+        "vision_data": vision_data,
+        "debate_rounds": debate_result["rounds"],
+        "final_recommendation": final_recommendation,
+        "voice_url": voice_url,
+        "health_score": health_score
+    }
+
+
+async def _insert_detected_products(products: list):
+    if products:
+        await db.execute(db.client.table("detected_products").insert(products))
+
+
+async def _insert_debate_rounds(scan_id: str, rounds: list):
+    """Save all debate rounds for a scan in one multi-row insert"""
+    if not rounds:
+        return
+    now_iso = datetime.utcnow().isoformat()
+    await db.execute(db.client.table("debate_rounds").insert([
+        {
+            "scan_id": scan_id,
+            "agent_name": round_data["agent"],
+            "agent_type": round_data["type"],
+            "recommendation": round_data["output"],
+            "reasoning": round_data.get("reasoning", ""),
+            "created_at": now_iso
+        }
+        for round_data in rounds
+    ]))
+
+
+async def _complete_scan(store: dict, scan_id: str, vision_data: dict, final_recommendation: str,
+                         rounds: list, voice_task: asyncio.Task,
+                         delivered_via: Optional[str] = None) -> tuple[int, str]:
+    """
+    Write everything a finished scan needs; returns (health_score, voice_url).
+    Only the voice note row and the scans update wait on the voice render,
+    so the debate rounds, store and neighborhood writes run while it's in flight.
+    """
+    store_id = store["id"]
+    now_iso = datetime.utcnow().isoformat()
+    health_score = _calculate_health_score(vision_data)
+
+    *_, (voice_url, voice_duration) = await asyncio.gather(
+        _insert_debate_rounds(scan_id, rounds),
+        db.execute(db.client.table("stores").update({
+            "total_scans": (store.get("total_scans", 0) + 1),
+            "shelf_health_score": health_score,
+            "last_scan_at": now_iso
+        }).eq("id", store_id)),
+        _update_neighborhood(store_id, store.get("pincode"), vision_data),
+        voice_task
+    )
+
+    voice_note = {
+        "scan_id": scan_id,
+        "store_id": store_id,
+        "audio_url": voice_url,
+        "duration_seconds": voice_duration,
+        "language": "hindi",
+        "text_content": final_recommendation,
+        "created_at": now_iso
+    }
+    if delivered_via:
+        voice_note["delivered_via"] = delivered_via
+
+    await asyncio.gather(
+        db.execute(db.client.table("voice_notes").insert(voice_note)),
+        db.execute(db.client.table("scans").update({
+            "status": "completed",
+            "shelf_health_score": health_score,
+            "products_detected": len(vision_data.get("products", [])),
+            "critical_items": vision_data.get("critical_count", 0),
+            "vision_summary": orjson.dumps(vision_data.get("summary", {})).decode(),
+            "final_recommendation": final_recommendation,
+            "voice_note_url": voice_url,
+            "completed_at": now_iso
+        }).eq("id", scan_id))
+    )
+    _dashboard_cache.pop(store_id, None)
+    return health_score, voice_url
+
+
+@asynccontextmanager
+async def _timed(stage: str):
+    """Record how long the wrapped block took, including time spent suspended in awaits"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_timings.append((stage, time.perf_counter() - start))
+
+
+async def _upload_scan_image(image_bytes: Union[bytes, bytearray], store_id: str, scan_id: str) -> str:
+    """Upload the shelf photo off the request path and attach its URL to the scan row"""
+    try:
+        image_url = await upload_image(image_bytes, store_id)
+        await db.execute(db.client.table("scans").update({
+            "image_url": image_url,
+            "pending_upload": False
+        }).eq("id", scan_id))
+        # The dashboard may have been cached while the photo was still pending
+        _dashboard_cache.pop(store_id, None)
+        return image_url
+    except Exception as e:
+        print(f"❌ Image upload failed for scan {scan_id}: {e}")
+        return ""
+
+
+def _canonical_number(number: str) -> str:
+    """Normalize a phone number to the +E164 form stores.whatsapp_number is saved in"""
+    digits = "".join(ch for ch in number if ch.isdigit())
+    if len(digits) == 10:
+        digits = "91" + digits
+    return "+" + digits
+
+
 def _calculate_health_score(vision_data: dict) -> int:
     products = vision_data.get("products", [])
     if not products:
@@ -434,22 +655,35 @@ def _calculate_health_score(vision_data: dict) -> int:
     return min(100, max(0, score))
 
 
+# Dashboard shows at most this many alerts
+MAX_ALERTS = 15
+
+_ALERT_FORMATS = {
+    "critical": ("critical", lambda name, p: f"{name} — OUT OF STOCK"),
+    "low": ("warning", lambda name, p: f"{name} — Low stock ({p.get('quantity_estimate', '?')} units)"),
+}
+
+
 def _build_alerts(products: list) -> list:
     alerts = []
     seen = set()
     for p in products:
-        name = p.get("product_name", "Unknown")
+        get = p.get
+        name = get("product_name", "Unknown")
         if name in seen:
             continue
         seen.add(name)
-        level = p.get("stock_level", "ok")
-        if level == "critical":
-            alerts.append({"type": "critical", "message": f"{name} — OUT OF STOCK", "product": name})
-        elif level == "low":
-            alerts.append({"type": "warning", "message": f"{name} — Low stock ({p.get('quantity_estimate', '?')} units)", "product": name})
-        elif not p.get("facing_correct", True):
+        fmt = _ALERT_FORMATS.get(get("stock_level", "ok"))
+        if fmt:
+            alert_type, message = fmt
+            alerts.append({"type": alert_type, "message": message(name, p), "product": name})
+        elif not get("facing_correct", True):
             alerts.append({"type": "info", "message": f"{name} — Incorrect shelf facing", "product": name})
-    return alerts[:15]
+        else:
+            continue
+        if len(alerts) >= MAX_ALERTS:
+            break
+    return alerts
 
 
 async def _init_neighborhood(store_id: str, pincode: str, city: str):
@@ -460,11 +694,11 @@ async def _init_neighborhood(store_id: str, pincode: str, city: str):
             db.client.table("neighborhood_demand").insert({
                 "pincode": pincode,
                 "city": city,
-                "week_start": datetime.utcnow().strftime("%Y-%m-%d"),
+                "week_start": datetime.utcnow().date().isoformat(),
                 "total_stores_scanned": 1,
-                "top_categories": json.dumps([]),
-                "stockout_products": json.dumps([]),
-                "demand_signals": json.dumps({})
+                "top_categories": EMPTY_JSON_LIST,
+                "stockout_products": EMPTY_JSON_LIST,
+                "demand_signals": EMPTY_JSON_OBJ
             }).execute()
     except:
         pass
@@ -478,27 +712,43 @@ async def _update_neighborhood(store_id: str, pincode: str, vision_data: dict):
         stockouts = [p["name"] for p in products if p.get("stock_level") == "critical"]
         categories = list(set(p.get("category", "") for p in products if p.get("category")))
 
-        existing = db.client.table("neighborhood_demand") \
-            .select("*") \
-            .eq("pincode", pincode) \
-            .order("week_start", desc=True) \
-            .limit(1) \
-            .execute()
-
-        if existing.data:
-            row = existing.data[0]
-            current_stockouts = json.loads(row.get("stockout_products", "[]"))
-            all_stockouts = list(set(current_stockouts + stockouts))
-
-            db.client.table("neighborhood_demand").update({
-                "stockout_products": json.dumps(all_stockouts),
-                "top_categories": json.dumps(categories),
-                "total_stores_scanned": row.get("total_stores_scanned", 0) + 1,
-                "updated_at": datetime.utcnow().isoformat()
-            }).eq("id", row["id"]).execute()
+        # Union + counter bump happen in one statement, so overlapping scans can't lose updates
+        await db.execute(db.client.rpc("append_stockouts", {
+            "p_pincode": pincode,
+            "p_stockouts": stockouts,
+            "p_categories": categories
+        }))
     except:
         pass
 
+GREET_WORDS = frozenset({"hi", "hello", "hey", "help", "start", "scan", "namaste", "namaskar"})
+
+GREETING_REPLY = (
+    "Hello! I am ShelfScan AI 🤖\n\n"
+    "Please send a photo of your shelf, and in 30 seconds I will tell you:\n"
+    "• What products need to be ordered\n"
+    "• Current stock levels\n"
+    "• How to rearrange your shelf for optimal display\n\n"
+    "You will receive a recommendation in a Hindi voice note! 🎙️\n\n"
+    "If you are a new user, please register first:\n"
+    "🔗 shelfscan.ai"
+)
+
+def _twiml(body: str) -> bytes:
+    """Single-message TwiML document with the body XML-escaped"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f"<Response><Message><Body>{escape(body)}</Body></Message></Response>"
+    ).encode()
+
+
+# Webhook replies are static, so they're rendered to bytes once at import
+GREETING_TWIML_BYTES = _twiml(GREETING_REPLY)
+SEND_PHOTO_TWIML_BYTES = _twiml("Please send a photo of your shelf for analysis! 📸")
+NO_MEDIA_TWIML_BYTES = _twiml("Image not received. Please try again.")
+PROCESSING_TWIML_BYTES = build_processing_twiml().encode()
+
+
 @app.post("/webhook/whatsapp")
 async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     """
@@ -513,52 +763,28 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     num_media = int(form.get("NumMedia", 0))
     body_text = form.get("Body", "").strip().lower()
 
-    try:
-        db.client.table("whatsapp_messages").insert({
-            "whatsapp_number": from_number,
-            "direction": "inbound",
-            "message_type": "image" if num_media > 0 else "text",
-            "message_content": body_text,
-            "media_url": form.get("MediaUrl0", ""),
-            "status": "received",
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
-    except Exception:
-        pass  
-    if num_media == 0:
-        greet_msgs = {"hi", "hello", "hey", "help", "start", "scan", "namaste", "namaskar"}
-        if any(w in body_text for w in greet_msgs) or body_text == "":
-            reply = (
-                "Hello! I am ShelfScan AI 🤖\n\n"
-                "Please send a photo of your shelf, and in 30 seconds I will tell you:\n"
-                "• What products need to be ordered\n"
-                "• Current stock levels\n"
-                "• How to rearrange your shelf for optimal display\n\n"
-                "You will receive a recommendation in a Hindi voice note! 🎙️\n\n"
-                "If you are a new user, please register first:\n"
-                f"🔗 shelfscan.ai"
-            )
-            return Response(
-                content=f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response><Message><Body>{reply}</Body></Message></Response>""",
-                media_type="text/xml"
-            )
+    # Logged after the TwiML goes out; Twilio only waits 5s for the ack
+    background_tasks.add_task(_enqueue_wa_log, {
+        "whatsapp_number": from_number,
+        "direction": "inbound",
+        "message_type": "image" if num_media > 0 else "text",
+        "message_content": body_text,
+        "media_url": form.get("MediaUrl0", ""),
+        "status": "received",
+        "created_at": datetime.utcnow().isoformat()
+    })
 
-        return Response(
-            content="""<?xml version="1.0" encoding="UTF-8"?>
-<Response><Message><Body>Please send a photo of your shelf for analysis! 📸</Body></Message></Response>""",
-            media_type="text/xml"
-        )
+    if num_media == 0:
+        # Exact hits take the set lookup; only longer messages pay for the substring scan
+        if not body_text or body_text in GREET_WORDS or any(w in body_text for w in GREET_WORDS):
+            return Response(content=GREETING_TWIML_BYTES, media_type="text/xml")
+        return Response(content=SEND_PHOTO_TWIML_BYTES, media_type="text/xml")
 
     media_url = form.get("MediaUrl0", "")
     media_type = form.get("MediaContentType0", "image/jpeg")
 
     if not media_url:
-        return Response(
-            content="""<?xml version="1.0" encoding="UTF-8"?>
-<Response><Message><Body>Image not received. Please try again.</Body></Message></Response>""",
-            media_type="text/xml"
-        )
+        return Response(content=NO_MEDIA_TWIML_BYTES, media_type="text/xml")
 
     background_tasks.add_task(
         _run_whatsapp_pipeline,
@@ -566,7 +792,37 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
         media_url=media_url,
         media_type=media_type
     )
-    return Response(content=build_processing_twiml(), media_type="text/xml")
+    return Response(content=PROCESSING_TWIML_BYTES, media_type="text/xml")
+
+
+async def _enqueue_wa_log(message: dict):
+    """Buffer a whatsapp_messages row; rows go out as one multi-row insert per batch"""
+    global _wa_log_timer
+    # Multi-row inserts need a uniform column set
+    _wa_log_buffer.append({**dict.fromkeys(WA_LOG_COLUMNS), **message})
+    if len(_wa_log_buffer) >= WA_LOG_BATCH_SIZE:
+        spawn(_flush_wa_log())
+    elif _wa_log_timer is None:
+        _wa_log_timer = spawn(_flush_wa_log_after(WA_LOG_FLUSH_SECONDS))
+
+
+async def _flush_wa_log_after(delay: float):
+    global _wa_log_timer
+    await asyncio.sleep(delay)
+    _wa_log_timer = None
+    await _flush_wa_log()
+
+
+async def _flush_wa_log():
+    """Best-effort write of everything buffered; never fails the caller"""
+    batch = _wa_log_buffer[:]
+    _wa_log_buffer.clear()
+    if not batch:
+        return
+    try:
+        await db.execute(db.client.table("whatsapp_messages").insert(batch))
+    except Exception as e:
+        print(f"✗ WhatsApp log insert failed ({len(batch)} rows): {e}")
 
 
 async def _run_whatsapp_pipeline(from_number: str, media_url: str, media_type: str):
@@ -583,13 +839,12 @@ async def _run_whatsapp_pipeline(from_number: str, media_url: str, media_type: s
         return
 
     try:
-        clean_number = from_number.lstrip("+")
-        store_res = (
-            db.client.table("stores")
-            .select("*")
-            .or_(f"whatsapp_number.eq.{from_number},whatsapp_number.eq.+{clean_number}")
-            .execute()
-        )
+        now_iso = datetime.utcnow().isoformat()
+        async with _timed("download"):
+            store_res, image_bytes = await asyncio.gather(
+                db.execute(db.client.table("stores").select("*").eq("whatsapp_number", _canonical_number(from_number))),
+                download_media(media_url, account_sid, auth_token)
+            )
 
         if not store_res.data:
             await send_whatsapp_text(
@@ -608,102 +863,45 @@ async def _run_whatsapp_pipeline(from_number: str, media_url: str, media_type: s
         store = store_res.data[0]
         store_id = store["id"]
 
-        image_bytes = await download_media(media_url, account_sid, auth_token)
-
-        image_url = await upload_image(image_bytes, store_id)
-
-        scan_record = {
-            "store_id": store_id,
-            "image_url": image_url,
-            "status": "processing",
-            "created_at": datetime.utcnow().isoformat()
-        }
-        scan_result = db.client.table("scans").insert(scan_record).execute()
-        scan_id = scan_result.data[0]["id"]
-
         # Log outbound message link
-        db.client.table("whatsapp_messages").insert({
+        await _enqueue_wa_log({
             "store_id": store_id,
             "whatsapp_number": from_number,
             "direction": "inbound",
             "message_type": "image",
-            "media_url": image_url,
+            "media_url": media_url,
             "status": "processing",
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
-
-        vision_data = await analyze_shelf_image(image_url, image_bytes)
-
-        if vision_data.get("products"):
-            products_to_insert = [
-                {
-                    "scan_id": scan_id,
-                    "store_id": store_id,
-                    "product_name": p.get("name", p.get("product_name", "Unknown")),
-                    "brand": p.get("brand", ""),
-                    "category": p.get("category", "General"),
-                    "stock_level": p.get("stock_level", "ok"),
-                    "quantity_estimate": p.get("quantity", 0),
-                    "facing_correct": p.get("facing_correct", True),
-                    "shelf_position": p.get("shelf_position", ""),
-                    "detected_at": datetime.utcnow().isoformat()
-                }
-                for p in vision_data["products"]
-            ]
-            db.client.table("detected_products").insert(products_to_insert).execute()
-        debate_result = await run_ai_debate(
-            vision_data=vision_data,
-            store_info=store,
-            pincode=store.get("pincode", "")
-        )
-
-        for round_data in debate_result["rounds"]:
-            db.client.table("debate_rounds").insert({
-                "scan_id": scan_id,
-                "agent_name": round_data["agent"],
-                "agent_type": round_data["type"],
-                "recommendation": round_data["output"],
-                "reasoning": round_data.get("reasoning", ""),
+            "created_at": now_iso
+        })
+
+        result = await _run_scan_pipeline(store, image_bytes, delivered_via="whatsapp")
+        scan_id = result["scan_id"]
+
+        if result["retake"]:
+            async with _timed("reply"):
+                await send_whatsapp_text(
+                    to=from_number,
+                    body=RETAKE_MESSAGE,
+                    from_number=from_wa,
+                    account_sid=account_sid,
+                    auth_token=auth_token
+                )
+            await _enqueue_wa_log({
+                "store_id": store_id,
+                "whatsapp_number": from_number,
+                "direction": "outbound",
+                "message_type": "text",
+                "message_content": RETAKE_MESSAGE,
+                "status": "delivered",
                 "created_at": datetime.utcnow().isoformat()
-            }).execute()
-
-        final_recommendation = debate_result["final_recommendation"]
-        voice_url, voice_duration = await generate_hindi_voice(
-            final_recommendation,
-            store_name=store.get("store_name", ""),
-            scan_id=scan_id
-        )
-
-        db.client.table("voice_notes").insert({
-            "scan_id": scan_id,
-            "store_id": store_id,
-            "audio_url": voice_url,
-            "duration_seconds": voice_duration,
-            "language": "hindi",
-            "text_content": final_recommendation,
-            "delivered_via": "whatsapp",
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
-
-        health_score = _calculate_health_score(vision_data)
-        db.client.table("scans").update({
-            "status": "completed",
-            "shelf_health_score": health_score,
-            "products_detected": len(vision_data.get("products", [])),
-            "critical_items": vision_data.get("critical_count", 0),
-            "vision_summary": json.dumps(vision_data.get("summary", {})),
-            "final_recommendation": final_recommendation,
-            "voice_note_url": voice_url,
-            "completed_at": datetime.utcnow().isoformat()
-        }).eq("id", scan_id).execute()
-
-        db.client.table("stores").update({
-            "total_scans": (store.get("total_scans", 0) + 1),
-            "shelf_health_score": health_score,
-            "last_scan_at": datetime.utcnow().isoformat()
-        }).eq("id", store_id).execute()
+            })
+            print(f"⚠ WhatsApp photo from {from_number} too dark or blank — asked for retake (scan_id: {scan_id})")
+            return
 
-        await _update_neighborhood(store_id, store.get("pincode"), vision_data)
+        vision_data = result["vision_data"]
+        final_recommendation = result["final_recommendation"]
+        voice_url = result["voice_url"]
+        health_score = result["health_score"]
 
         critical_count = vision_data.get("critical_count", 0)
         low_count = vision_data.get("low_count", 0)
@@ -713,25 +911,26 @@ async def _run_whatsapp_pipeline(from_number: str, media_url: str, media_type: s
             f"🎙️ Hindi voice note neeche hai:"
         )
 
-        if voice_url:
-            await send_whatsapp_media(
-                to=from_number,
-                body=caption,
-                media_url=voice_url,
-                from_number=from_wa,
-                account_sid=account_sid,
-                auth_token=auth_token
-            )
-        else:
-            short_rec = final_recommendation[:1000] if len(final_recommendation) > 1000 else final_recommendation
-            await send_whatsapp_text(
-                to=from_number,
-                body=f"{caption}\n\n{short_rec}",
-                from_number=from_wa,
-                account_sid=account_sid,
-                auth_token=auth_token
-            )
-        db.client.table("whatsapp_messages").insert({
+        async with _timed("reply"):
+            if voice_url:
+                await send_whatsapp_media(
+                    to=from_number,
+                    body=caption,
+                    media_url=voice_url,
+                    from_number=from_wa,
+                    account_sid=account_sid,
+                    auth_token=auth_token
+                )
+            else:
+                short_rec = final_recommendation[:1000] if len(final_recommendation) > 1000 else final_recommendation
+                await send_whatsapp_text(
+                    to=from_number,
+                    body=f"{caption}\n\n{short_rec}",
+                    from_number=from_wa,
+                    account_sid=account_sid,
+                    auth_token=auth_token
+                )
+        await _enqueue_wa_log({
             "store_id": store_id,
             "whatsapp_number": from_number,
             "direction": "outbound",
@@ -740,7 +939,7 @@ async def _run_whatsapp_pipeline(from_number: str, media_url: str, media_type: s
             "media_url": voice_url,
             "status": "delivered",
             "created_at": datetime.utcnow().isoformat()
-        }).execute()
+        })
 
         print(f"✅ WhatsApp pipeline complete for {from_number} — scan_id: {scan_id}")
 
@@ -759,4 +958,4 @@ async def _run_whatsapp_pipeline(from_number: str, media_url: str, media_type: s
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("main:app", host=settings.HOST, port=settings.PORT, reload=settings.DEBUG, loop="uvloop", http="httptools")
@@ -2,6 +2,11 @@ from pydantic import BaseModel, validator
 from typing import Optional
 import re
 
+_PHONE_STRIP = re.compile(r"[\s\-\(\)]")
+_INDIAN_MOBILE = re.compile(r"^(\+91|91)?[6-9]\d{9}$")
+_NON_DIGITS = re.compile(r"[^\d]")
+_PINCODE = re.compile(r"^\d{6}$")
+
 
 class StoreRegister(BaseModel):
     owner_name: str
@@ -20,10 +25,10 @@ class StoreRegister(BaseModel):
 
     @validator("whatsapp_number")
     def validate_phone(cls, v):
-        clean = re.sub(r"[\s\-\(\)]", "", v)
-        if not re.match(r"^(\+91|91)?[6-9]\d{9}$", clean):
+        clean = _PHONE_STRIP.sub("", v)
+        if not _INDIAN_MOBILE.match(clean):
             raise ValueError("Invalid Indian WhatsApp number")
-        digits = re.sub(r"[^\d]", "", clean)
+        digits = _NON_DIGITS.sub("", clean)
         if len(digits) == 10:
             return "+91" + digits
         if len(digits) == 12 and digits.startswith("91"):
@@ -32,7 +37,7 @@ class StoreRegister(BaseModel):
 
     @validator("pincode")
     def validate_pincode(cls, v):
-        if not re.match(r"^\d{6}$", v):
+        if not _PINCODE.match(v):
             raise ValueError("Pincode must be 6 digits")
         return v
 
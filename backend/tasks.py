@@ -0,0 +1,12 @@
+"""ShelfScan AI — Fire-and-forget background tasks"""
+import asyncio
+
+# Strong refs for fire-and-forget tasks; the event loop only keeps weak ones
+_background_tasks = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task